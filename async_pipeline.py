@@ -0,0 +1,125 @@
+#### Imports
+import os
+import asyncio
+import json
+import traceback
+import aiohttp
+import openai
+from azure.core.pipeline.transport import AioHttpTransport
+from utils import find_questions_and_answers, cached_embeddings, store_embeddings, add_question_labels, store_document_fields, \
+    build_template_fields, document_fields_cache, EMBEDDING_ENGINE, EMBEDDING_BATCH_SIZE, DOCUMENT_MODEL_ID
+from validation import validate_advanced_conditions_async
+from clients import create_embedding_async, analyze_document_async
+from cache import hash_key
+from pipeline import template_groups, checkpoint_keys, load_checkpoint, save_checkpoint, merge_results
+
+# Same pipeline as pipeline.run_pipeline, but all requests (embeddings, document analysis, GPT-4) of all templates are
+# sent from one event loop with the async OpenAI and Document Intelligence clients instead of a thread per request.
+# Used instead of run_pipeline if ASYNC_PIPELINE is "1".
+ASYNC_PIPELINE = os.environ.get("ASYNC_PIPELINE", "0") == "1"
+
+# Number of templates that are extracted and validated at the same time (requests are limited by clients.py as well)
+ASYNC_TEMPLATES = int(os.environ.get("ASYNC_TEMPLATES", 16))
+# Size of the HTTP connection pool shared by all requests of a run
+ASYNC_CONNECTIONS = int(os.environ.get("ASYNC_CONNECTIONS", 32))
+
+async def generate_embeddings_batch_async(texts: list, batch_size: int = EMBEDDING_BATCH_SIZE, billed: list = None) -> list:
+    # like utils.generate_embeddings_batch, all batches are sent at the same time
+    embeddings, missing = cached_embeddings(texts)
+
+    missing_texts = list(missing.keys())
+    batches = [missing_texts[start:start+batch_size] for start in range(0, len(missing_texts), batch_size)]
+    responses = await asyncio.gather(*[create_embedding_async(batch, EMBEDDING_ENGINE) for batch in batches])
+    for batch, response in zip(batches, responses):
+        store_embeddings(batch, response, missing, embeddings)
+        if billed is not None:
+            billed.append({"embeddings": len(batch)})
+
+    return embeddings
+
+async def document_fields_async(document, start_page: int, document_analysis_client, billed: list = None) -> dict:
+    page_pdf = document.page_pdf(start_page)
+    key = hash_key(DOCUMENT_MODEL_ID, page_pdf)
+    cached = document_fields_cache.get(key)
+    if cached is not None:
+        return json.loads(cached)
+    fields = store_document_fields(key, await analyze_document_async(document_analysis_client, DOCUMENT_MODEL_ID, page_pdf))
+    if billed is not None:
+        billed.append({"document_pages": 1})
+    return fields
+
+async def extract_template_data_async(template, document, document_analysis_client, question_labeller, billed: list = None):
+    # like utils.extract_template_data, embeddings of the questions and the fields of the first page are requested at the same time
+    q_n_a_pairs = find_questions_and_answers(template, document)
+
+    question_embeddings, fields = await asyncio.gather(
+        generate_embeddings_batch_async(list(q_n_a_pairs.keys()), billed=billed),
+        document_fields_async(document, template["start_page"], document_analysis_client, billed)
+    )
+    add_question_labels(template, q_n_a_pairs, question_embeddings, question_labeller)
+
+    for k, v in fields.items():
+        template[k] = v
+
+    return template
+
+async def run_pipeline_async(template_list, document, create_document_analysis_client, question_labeller, on_extracted=None, on_validated=None, file_hash: str = None, billed: list = None, resumed: list = None):
+    # Extract and validate all templates on the running event loop (see pipeline.run_pipeline for callbacks, checkpoints and result).
+    # create_document_analysis_client is called with the transport of the shared connection pool and returns an
+    # azure.ai.formrecognizer.aio.DocumentAnalysisClient.
+    template_count = len(template_list)
+    extracted_templates = [None] * template_count
+    validation_results = [None] * template_count
+    counts = {"extracted": 0, "validated": 0}
+    metrics = []
+    templates = asyncio.Semaphore(ASYNC_TEMPLATES)
+    groups = template_groups(template_list)
+    keys = checkpoint_keys(file_hash, template_list)
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=ASYNC_CONNECTIONS)) as session:
+        # (OpenAI and Document Intelligence requests share the connections of the session)
+        openai.aiosession.set(session)
+        transport = AioHttpTransport(session=session, session_owner=False)
+
+        async with create_document_analysis_client(transport=transport) as document_analysis_client:
+
+            async def process(i, template):
+                async with templates:
+                    template_data = load_checkpoint(keys[i]["extraction"], resumed)
+                    if template_data is None:
+                        template_data = await extract_template_data_async(dict(template), document, document_analysis_client, question_labeller, billed)
+                        save_checkpoint(keys[i]["extraction"], template_data)
+                    extracted_templates[i] = template_data
+                    counts["extracted"] += 1
+                    if on_extracted is not None:
+                        on_extracted(i, counts["extracted"])
+
+                    # (the templates of an identifier are validated together by the last of them to be extracted)
+                    if not all(extracted_templates[j] is not None for j in groups[i]):
+                        return
+                    conditions = load_checkpoint(keys[i]["validation"], resumed)
+                    if conditions is None:
+                        template_fields = build_template_fields([extracted_templates[j] for j in groups[i]])
+                        conditions = await validate_advanced_conditions_async(template_fields, template_data["f_legal_entity_identifier"], metrics)
+                        save_checkpoint(keys[i]["validation"], conditions)
+                    for j in groups[i]:
+                        validation_results[j] = conditions
+                        counts["validated"] += 1
+                        if on_validated is not None:
+                            on_validated(j, counts["validated"])
+
+            # (a failed template does not stop the others, the first error is raised once all templates are finished)
+            outcomes = await asyncio.gather(*[process(i, template) for i, template in enumerate(template_list)], return_exceptions=True)
+
+    errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+    for error in errors:
+        traceback.print_exception(type(error), error, error.__traceback__)
+    if errors:
+        raise errors[0]
+
+    return merge_results(extracted_templates, validation_results, metrics, groups)
+
+def run_pipeline_in_event_loop(template_list, document, create_document_analysis_client, question_labeller, on_extracted=None, on_validated=None, file_hash: str = None, billed: list = None, resumed: list = None):
+    # run_pipeline_async on a new event loop of the calling thread (e.g. a job worker), returns when all templates are finished
+    return asyncio.run(run_pipeline_async(template_list, document, create_document_analysis_client, question_labeller,
+                                          on_extracted, on_validated, file_hash, billed, resumed))
@@ -0,0 +1,125 @@
+#### Imports
+import os
+import sqlite3
+import hashlib
+import threading
+import time
+
+# All persistent caches are stored in this directory (one SQLite file per cache)
+CACHE_DIR = os.environ.get("SFDR_CACHE_DIR", ".cache")
+
+# All caches created by the app (for statistics)
+caches = []
+
+def cache_statistics() -> dict:
+    # hits and misses of all caches since the start of the app
+    return {cache.name: cache.stats() for cache in caches}
+
+def cache_statistics_delta(before: dict) -> dict:
+    # hits and misses of all caches since the statistics before were taken (e.g. during one run)
+    delta = {}
+    for name, stats in cache_statistics().items():
+        delta[name] = {
+            "hits": stats["hits"] - before.get(name, {}).get("hits", 0),
+            "misses": stats["misses"] - before.get(name, {}).get("misses", 0)
+        }
+    return delta
+
+def format_cache_statistics(statistics: dict) -> list:
+    # one line per cache, e.g. for the summary of a run
+    return ["{} cache: {} hit(s), {} miss(es)".format(name.replace("_", " ").capitalize(), stats["hits"], stats["misses"])
+            for name, stats in statistics.items()]
+
+def hash_key(*parts) -> str:
+    # content-addressed key: SHA-256 over all parts (e.g. model name and text)
+    sha = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = str(part).encode("utf-8")
+        sha.update(part)
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+class SQLiteCache:
+    # Key-value store with least-recently-used eviction once max_entries (or max_bytes of stored values) is exceeded.
+    # Entries older than ttl seconds are treated as missing (no expiry if ttl is None).
+    # Stored on disk unless persist is False (then it only lives in memory of the current process).
+    # One instance can be shared between threads; hit and miss counters are kept per process.
+
+    def __init__(self, name: str, max_entries: int, max_bytes: int = None, ttl: float = None, persist: bool = True):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.persist = persist
+        self.path = os.path.join(CACHE_DIR, name + ".sqlite") if persist else ":memory:"
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        self._lock = threading.Lock()
+        caches.append(self)
+
+    def _connect(self):
+        if self._connection is None:
+            if self.persist:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, last_used REAL, created REAL)")
+            # (cache files written by earlier versions have no created column)
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(entries)")]
+            if "created" not in columns:
+                self._connection.execute("ALTER TABLE entries ADD COLUMN created REAL")
+                self._connection.execute("UPDATE entries SET created = last_used")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+            self._connection.commit()
+        return self._connection
+
+    def get(self, key: str):
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            if row is not None and self.ttl is not None and row[1] < now - self.ttl:
+                # expired
+                connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                connection.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            connection.execute("UPDATE entries SET last_used = ? WHERE key = ?", (now, key))
+            connection.commit()
+            return row[0]
+
+    def set(self, key: str, value: bytes):
+        with self._lock:
+            connection = self._connect()
+            now = time.time()
+            connection.execute("INSERT OR REPLACE INTO entries (key, value, last_used, created) VALUES (?, ?, ?, ?)", (key, value, now, now))
+
+            # evict least recently used entries if the cache grew too large
+            count = connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            if count > self.max_entries:
+                connection.execute("DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+
+            if self.max_bytes is not None:
+                total_bytes = connection.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM entries").fetchone()[0]
+                if total_bytes > self.max_bytes:
+                    evicted = []
+                    for old_key, size in connection.execute("SELECT key, LENGTH(value) FROM entries ORDER BY last_used"):
+                        if total_bytes <= self.max_bytes:
+                            break
+                        evicted.append((old_key,))
+                        total_bytes -= size
+                    connection.executemany("DELETE FROM entries WHERE key = ?", evicted)
+            connection.commit()
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "name": self.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests > 0 else 0.0
+        }
@@ -0,0 +1,217 @@
+#### Imports
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import traceback
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils import find_templates_in_pdf, generate_question_embeddings, QuestionLabeller, validation_results_to_excel
+from pipeline import run_pipeline
+from async_pipeline import run_pipeline_in_event_loop, ASYNC_PIPELINE
+from document import ParsedDocument
+from estimation import usage_history
+from cache import cache_statistics, cache_statistics_delta, format_cache_statistics
+from clients import client_statistics, client_statistics_delta, format_client_statistics, create_document_analysis_client
+
+# Batch validation of many PDF files without Streamlit, e.g.
+# $ python cli.py prospectuses/ --output-dir results --workers 4
+# $ python cli.py manifest.txt --output-dir results
+
+# Number of files that are processed at the same time (each of them extracts and validates several templates in parallel)
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", 2))
+
+# Files in the output directory: state of finished files (one JSON line per file, used to resume) and summary of the batch
+STATE_FILE = "batch_state.jsonl"
+SUMMARY_FILE = "summary.csv"
+SUMMARY_COLUMNS = ["file", "status", "output", "templates", "pages", "conditions_passed", "conditions_failed", "estimated_euros",
+                   "actual_euros", "llm_euros", "prompt_tokens", "completion_tokens", "seconds", "error", "file_hash"]
+
+def find_pdf_files(inputs: list) -> list:
+    # PDF files of the given folders (including subfolders), manifests (text files with one path per line) and single files
+    files = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names if name.lower().endswith(".pdf"))
+        elif path.lower().endswith(".pdf"):
+            files.append(path)
+        else:
+            with open(path, encoding="utf-8") as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        # (relative paths are relative to the manifest)
+                        files.append(os.path.join(os.path.dirname(path), line))
+
+    # each file only once, in a stable order
+    return sorted(set(os.path.normpath(file) for file in files))
+
+def output_names(files: list, state: dict = None) -> dict:
+    # name of the workbook of each file: files that have a workbook from an earlier run keep its name, other files get their
+    # file name without extension (files with a name that is already used get a short hash of their path added, so names
+    # do not depend on the other files of the batch)
+    names = {}
+    used = set()
+    for file in files:
+        entry = (state or {}).get(file)
+        if entry is not None and entry.get("output"):
+            names[file] = entry["output"]
+            used.add(entry["output"])
+
+    for file in files:
+        if file in names:
+            continue
+        name = os.path.splitext(os.path.basename(file))[0] + ".xlsx"
+        if name in used:
+            name = "{}_{}.xlsx".format(os.path.splitext(os.path.basename(file))[0], hashlib.sha256(file.encode("utf-8")).hexdigest()[:8])
+        used.add(name)
+        names[file] = name
+    return names
+
+def load_state(output_dir: str) -> dict:
+    # latest state of each file processed by earlier (possibly interrupted) runs
+    state = {}
+    path = os.path.join(output_dir, STATE_FILE)
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as state_file:
+            for line in state_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # (last line may be incomplete after a crash)
+                    continue
+                state[entry["file"]] = entry
+    return state
+
+def is_finished(entry: dict, file_hash: str, output_dir: str) -> bool:
+    # finished files are not processed again, unless the file has changed or its workbook is missing
+    if entry is None or entry["file_hash"] != file_hash or entry["status"] not in ("done", "no_templates"):
+        return False
+    return entry["status"] == "no_templates" or os.path.exists(os.path.join(output_dir, entry["output"]))
+
+def process_file(data: bytes, output_path: str, document_analysis_client, question_labeller, file_hash: str = None) -> dict:
+    # find, extract and validate all templates of one PDF file and write its workbook
+    # (templates finished before an earlier run of the file failed are resumed from their checkpoints)
+    start_time = time.perf_counter()
+    entry = {"templates": 0, "pages": 0, "estimated_euros": 0.0, "actual_euros": 0.0, "prompt_tokens": 0, "completion_tokens": 0,
+             "llm_euros": 0.0, "conditions_passed": 0, "conditions_failed": 0}
+
+    document = ParsedDocument(data)
+    template_list = find_templates_in_pdf(document)
+    if len(template_list) == 0:
+        entry["status"] = "no_templates"
+        entry["seconds"] = time.perf_counter() - start_time
+        return entry
+
+    estimate = usage_history.estimate(template_list)
+    entry["templates"] = estimate["template_count"]
+    entry["pages"] = estimate["page_count"]
+    entry["estimated_euros"] = estimate["euros"]
+
+    billed = []
+    resumed = []
+    if ASYNC_PIPELINE:
+        # (each file gets its own event loop and async client, document_analysis_client is not used)
+        tempys, template_checks, metrics = run_pipeline_in_event_loop(template_list, document, lambda **kwargs: create_document_analysis_client(asynchronous=True, **kwargs),
+                                                                      question_labeller, file_hash=file_hash, billed=billed, resumed=resumed)
+    else:
+        tempys, template_checks, metrics = run_pipeline(template_list, document, document_analysis_client, question_labeller,
+                                                        file_hash=file_hash, billed=billed, resumed=resumed)
+    output = validation_results_to_excel(tempys, template_checks)
+
+    for conditions in template_checks.values():
+        entry["conditions_passed"] += sum(1 for condition in conditions if condition["value"] == True)
+        entry["conditions_failed"] += sum(1 for condition in conditions if condition["value"] == False)
+
+    # Record actual against predicted usage (batch runs improve the estimate of later runs as well)
+    actual = usage_history.record(template_list, estimate, time.perf_counter() - start_time, billed, metrics, file_hash, resumed)
+    for name in ("actual_euros", "llm_euros", "prompt_tokens", "completion_tokens"):
+        entry[name] = actual[name]
+
+    # (written under a temporary name first, so an interrupted run never leaves an incomplete workbook behind)
+    with open(output_path + ".tmp", "wb") as output_file:
+        output_file.write(output)
+    os.replace(output_path + ".tmp", output_path)
+
+    entry["status"] = "done"
+    entry["seconds"] = time.perf_counter() - start_time
+    return entry
+
+def run_batch(inputs: list, output_dir: str, workers: int = BATCH_WORKERS, force: bool = False) -> list:
+    # Validate all PDF files of the inputs, write one workbook per file and a summary of all files to output_dir.
+    # Files that have been finished by an earlier run are skipped (unless force is True).
+    os.makedirs(output_dir, exist_ok=True)
+    files = find_pdf_files(inputs)
+    # (workbooks of earlier runs keep their names, also if the files are processed again with force)
+    previous_state = load_state(output_dir)
+    state = {} if force else previous_state
+    names = output_names(files, previous_state)
+
+    pending = []
+    entries = {}
+    for file in files:
+        with open(file, "rb") as pdf_file:
+            file_hash = hashlib.sha256(pdf_file.read()).hexdigest()
+        if is_finished(state.get(file), file_hash, output_dir):
+            entries[file] = state[file]
+        else:
+            pending.append((file, file_hash))
+
+    print("{} file(s) found, {} already finished, {} to process.".format(len(files), len(entries), len(pending)))
+
+    if pending:
+        cache_statistics_before = cache_statistics()
+        client_statistics_before = client_statistics()
+        document_analysis_client = create_document_analysis_client()
+        # Generate embeddings of question variables for labelling of extracted paragraphs (shared by all files,
+        # not part of the usage recorded for any file)
+        question_labeller = QuestionLabeller(generate_question_embeddings())
+
+        def process(file, file_hash):
+            with open(file, "rb") as pdf_file:
+                data = pdf_file.read()
+            try:
+                entry = process_file(data, os.path.join(output_dir, names[file]), document_analysis_client, question_labeller, file_hash)
+            except Exception as e:
+                traceback.print_exc()
+                entry = {"status": "failed", "error": str(e)}
+            entry.update({"file": file, "file_hash": file_hash, "output": names[file] if entry["status"] == "done" else ""})
+            return entry
+
+        with ThreadPoolExecutor(max_workers=workers) as executor, open(os.path.join(output_dir, STATE_FILE), "a", encoding="utf-8") as state_file:
+            futures = [executor.submit(process, file, file_hash) for file, file_hash in pending]
+            for done, future in enumerate(as_completed(futures), 1):
+                entry = future.result()
+                entries[entry["file"]] = entry
+                # state is saved after each file (to resume after a crash)
+                state_file.write(json.dumps(entry) + "\n")
+                state_file.flush()
+                print("[{}/{}] {}: {}".format(done, len(pending), entry["file"], entry["status"]))
+
+        for line in format_cache_statistics(cache_statistics_delta(cache_statistics_before)) + format_client_statistics(client_statistics_delta(client_statistics_before)):
+            print(line)
+
+    # Summary of all files of the batch (in the order of the files)
+    summary = [entries[file] for file in files]
+    pd.DataFrame(summary, columns=SUMMARY_COLUMNS, dtype=object).to_csv(os.path.join(output_dir, SUMMARY_FILE), index=False)
+
+    failed = sum(1 for entry in summary if entry["status"] == "failed")
+    print("{} file(s) finished, {} failed. Summary written to {}.".format(len(summary) - failed, failed, os.path.join(output_dir, SUMMARY_FILE)))
+    return summary
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Validate SFDR templates of many PDF files without the Streamlit app.")
+    parser.add_argument("inputs", nargs="+", help="folders with PDF files, manifests (text file with one PDF path per line) or PDF files")
+    parser.add_argument("--output-dir", default="validation_results", help="folder for the workbooks and the summary")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS, help="number of files processed at the same time")
+    parser.add_argument("--force", action="store_true", help="process all files again, also the ones finished by an earlier run")
+    args = parser.parse_args(args)
+
+    summary = run_batch(args.inputs, args.output_dir, args.workers, args.force)
+    return 1 if any(entry["status"] == "failed" for entry in summary) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
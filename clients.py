@@ -0,0 +1,321 @@
+#### Imports
+import os
+import asyncio
+import json
+import random
+import threading
+import time
+import email.utils
+import openai
+import streamlit as st
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from azure.ai.formrecognizer import DocumentAnalysisClient
+from azure.ai.formrecognizer.aio import DocumentAnalysisClient as AsyncDocumentAnalysisClient
+
+# All requests to Azure OpenAI (embeddings, chat completions) and Azure AI Document Intelligence go through this layer:
+# requests wait for shared token buckets (one per endpoint and deployment, shared by all sessions and threads of the app),
+# failed requests are retried with jittered exponential backoff (honouring Retry-After of the service) and
+# requests, retries, throttling and rate limit errors are counted per endpoint.
+
+# Limits per minute of each endpoint (JSON, e.g. {"chat": {"requests_per_minute": 120, "tokens_per_minute": 20000}};
+# a single deployment can get its own limits, e.g. {"chat:gpt-35-turbo": {...}}). null means no limit.
+RATE_LIMITS = {
+    "embeddings": {"requests_per_minute": 1440, "tokens_per_minute": 240000},
+    "chat": {"requests_per_minute": 240, "tokens_per_minute": 40000},
+    "document_analysis": {"requests_per_minute": 900, "tokens_per_minute": None}
+}
+RATE_LIMITS.update(json.loads(os.environ.get("RATE_LIMITS", "{}")))
+
+# Retries of a failed request (rate limit, server error, timeout or lost connection) and bounds of the backoff in seconds
+MAX_RETRIES = int(os.environ.get("MAX_RETRIES", 6))
+BACKOFF_BASE = float(os.environ.get("BACKOFF_BASE", 1))
+BACKOFF_MAX = float(os.environ.get("BACKOFF_MAX", 60))
+
+RETRYABLE_ERRORS = (openai.error.RateLimitError, openai.error.APIError, openai.error.APIConnectionError, openai.error.Timeout,
+                    openai.error.ServiceUnavailableError, openai.error.TryAgain, HttpResponseError, ServiceRequestError, ServiceResponseError)
+
+class TokenBucket:
+    # Holds up to capacity tokens and refills capacity tokens per minute. Requests take tokens and wait while there are
+    # not enough of them. Tokens can be taken back or taken additionally once the actual usage of a request is known
+    # (the bucket can run into debt, later requests wait until it is paid off).
+
+    def __init__(self, capacity: float):
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def _reserve(self, amount: float) -> float:
+        # take amount tokens if they are available (returns 0), otherwise the seconds until they will be
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now >= self.paused_until and self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return max(self.paused_until - now, (amount - self.tokens) * 60 / self.capacity)
+
+    def acquire(self, amount: float = 1) -> float:
+        # take amount tokens (waits until they are available), returns the seconds waited
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        wait = self._reserve(amount)
+        while wait > 0:
+            time.sleep(wait)
+            waited += wait
+            wait = self._reserve(amount)
+        return waited
+
+    async def acquire_async(self, amount: float = 1) -> float:
+        # like acquire, but waits without blocking the event loop
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        wait = self._reserve(amount)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            waited += wait
+            wait = self._reserve(amount)
+        return waited
+
+    def adjust(self, amount: float):
+        # take additional tokens (or give tokens back if amount is negative)
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+    def pause(self, seconds: float):
+        # no tokens are handed out for the given time (e.g. after the service answered with a rate limit error)
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def rate_limits(endpoint: str, deployment: str = None) -> dict:
+    return RATE_LIMITS.get("{}:{}".format(endpoint, deployment), RATE_LIMITS.get(endpoint, {}))
+
+def buckets(endpoint: str, deployment: str = None) -> dict:
+    # request and token bucket of the endpoint (and deployment), created on first use
+    with _buckets_lock:
+        key = (endpoint, deployment)
+        if key not in _buckets:
+            limits = rate_limits(endpoint, deployment)
+            _buckets[key] = {
+                "requests": TokenBucket(limits["requests_per_minute"]) if limits.get("requests_per_minute") else None,
+                "tokens": TokenBucket(limits["tokens_per_minute"]) if limits.get("tokens_per_minute") else None
+            }
+        return _buckets[key]
+
+# Counters per endpoint since the start of the app
+_statistics = {}
+_statistics_lock = threading.Lock()
+
+def count(endpoint: str, **amounts):
+    with _statistics_lock:
+        stats = _statistics.setdefault(endpoint, {"requests": 0, "retries": 0, "rate_limited": 0, "errors": 0, "tokens": 0,
+                                                  "throttled_seconds": 0.0, "backoff_seconds": 0.0})
+        for name, amount in amounts.items():
+            stats[name] += amount
+
+def client_statistics() -> dict:
+    # requests, retries, rate limit errors, failed requests, tokens and seconds spent waiting of all endpoints
+    with _statistics_lock:
+        return {endpoint: dict(stats) for endpoint, stats in _statistics.items()}
+
+def client_statistics_delta(before: dict) -> dict:
+    # counters of all endpoints since the statistics before were taken (e.g. during one run)
+    delta = {}
+    for endpoint, stats in client_statistics().items():
+        delta[endpoint] = {name: value - before.get(endpoint, {}).get(name, 0) for name, value in stats.items()}
+    return delta
+
+def format_client_statistics(statistics: dict) -> list:
+    # one line per endpoint, e.g. for the summary of a run
+    return ["{} requests: {} sent, {} retried ({} rate limited), {} failed, {:0.1f} s throttled, {:0.1f} s backoff".format(
+                endpoint.replace("_", " ").capitalize(), stats["requests"], stats["retries"], stats["rate_limited"], stats["errors"],
+                stats["throttled_seconds"], stats["backoff_seconds"])
+            for endpoint, stats in statistics.items()]
+
+def error_status(error) -> int:
+    # HTTP status of a failed request (None if the service has not answered)
+    status = getattr(error, "http_status", None)
+    if status is None:
+        status = getattr(error, "status_code", None)
+    return status
+
+def retry_after(error) -> float:
+    # seconds to wait as requested by the service (Retry-After header), None if the service did not say
+    headers = getattr(error, "headers", None)
+    if not headers and getattr(error, "response", None) is not None:
+        headers = getattr(error.response, "headers", None)
+    if not headers:
+        return None
+    headers = {name.lower(): value for name, value in headers.items()}
+
+    for name in ("retry-after-ms", "x-ms-retry-after-ms"):
+        if name in headers:
+            try:
+                return float(headers[name]) / 1000
+            except ValueError:
+                pass
+    if "retry-after" in headers:
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            # (HTTP date instead of seconds)
+            date = email.utils.parsedate_to_datetime(headers["retry-after"])
+            return max(0.0, date.timestamp() - time.time()) if date is not None else None
+    return None
+
+def is_retryable(error) -> bool:
+    if not isinstance(error, RETRYABLE_ERRORS):
+        return False
+    status = error_status(error)
+    # (client errors other than rate limits, e.g. invalid requests, fail again when they are retried)
+    return status is None or status == 429 or status == 408 or status >= 500
+
+def backoff(attempt: int) -> float:
+    # exponential backoff with full jitter (requests of many threads that failed at the same time are spread out)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def retry_wait(endpoint: str, bucket: dict, error, attempt: int) -> float:
+    # seconds to wait before the failed request is sent again (raises the error if it is not retried)
+    if not is_retryable(error) or attempt >= MAX_RETRIES:
+        count(endpoint, errors=1)
+        raise error
+
+    wait = retry_after(error)
+    if wait is None:
+        wait = backoff(attempt)
+    if error_status(error) == 429:
+        # all other requests to the endpoint wait as well (instead of running into the same limit)
+        count(endpoint, rate_limited=1)
+        for limit in bucket.values():
+            if limit is not None:
+                limit.pause(wait)
+    count(endpoint, retries=1, backoff_seconds=wait)
+    return wait
+
+def record_tokens(endpoint: str, bucket: dict, response, tokens: float, used_tokens):
+    # correct the estimated tokens of the request with the actual tokens of the response
+    actual_tokens = used_tokens(response) if used_tokens is not None else None
+    if actual_tokens is None:
+        actual_tokens = tokens
+    elif bucket["tokens"] is not None:
+        bucket["tokens"].adjust(actual_tokens - tokens)
+    count(endpoint, tokens=actual_tokens)
+
+def release_tokens(bucket: dict, tokens: float):
+    # give back the tokens reserved for a failed request (the attempt is not billed, a retry reserves them again)
+    if bucket["tokens"] is not None and tokens > 0:
+        bucket["tokens"].adjust(-tokens)
+
+def call(endpoint: str, request, deployment: str = None, tokens: float = 0, used_tokens=None):
+    # send request (function without arguments) within the limits of the endpoint and retry it if it fails
+    # tokens: estimated tokens of the request, used_tokens: function that returns the actual tokens from the response
+    bucket = buckets(endpoint, deployment)
+    attempt = 0
+    while True:
+        throttled = 0.0
+        if bucket["requests"] is not None:
+            throttled += bucket["requests"].acquire()
+        if bucket["tokens"] is not None and tokens > 0:
+            throttled += bucket["tokens"].acquire(tokens)
+        count(endpoint, requests=1, throttled_seconds=throttled)
+
+        try:
+            response = request()
+        except Exception as e:
+            release_tokens(bucket, tokens)
+            time.sleep(retry_wait(endpoint, bucket, e, attempt))
+            attempt += 1
+            continue
+
+        record_tokens(endpoint, bucket, response, tokens, used_tokens)
+        return response
+
+async def call_async(endpoint: str, request, deployment: str = None, tokens: float = 0, used_tokens=None):
+    # like call, request is a function without arguments that returns an awaitable (shares limits and counters with call)
+    bucket = buckets(endpoint, deployment)
+    attempt = 0
+    while True:
+        throttled = 0.0
+        if bucket["requests"] is not None:
+            throttled += await bucket["requests"].acquire_async()
+        if bucket["tokens"] is not None and tokens > 0:
+            throttled += await bucket["tokens"].acquire_async(tokens)
+        count(endpoint, requests=1, throttled_seconds=throttled)
+
+        try:
+            response = await request()
+        except Exception as e:
+            release_tokens(bucket, tokens)
+            await asyncio.sleep(retry_wait(endpoint, bucket, e, attempt))
+            attempt += 1
+            continue
+
+        record_tokens(endpoint, bucket, response, tokens, used_tokens)
+        return response
+
+def create_document_analysis_client(asynchronous: bool = False, **kwargs) -> DocumentAnalysisClient:
+    # Set up Azure AI Document Intelligence (client of azure.ai.formrecognizer.aio if asynchronous, for the async pipeline)
+    try:
+        document_ai_endpoint = os.environ["DOCUMENT_AI_ENDPOINT"]
+        document_ai_key = os.environ["DOCUMENT_AI_KEY"]
+    except:
+        document_ai_endpoint = st.secrets["DOCUMENT_AI_ENDPOINT"]
+        document_ai_key = st.secrets["DOCUMENT_AI_KEY"]
+
+    client_class = AsyncDocumentAnalysisClient if asynchronous else DocumentAnalysisClient
+    return client_class(
+        endpoint=document_ai_endpoint, credential=AzureKeyCredential(document_ai_key), **kwargs
+    )
+
+def estimate_tokens(texts: list) -> int:
+    # rule of thumb: one token is about four characters
+    return sum(-(-len(text) // 4) for text in texts)
+
+def response_tokens(response):
+    usage = response.get("usage") if hasattr(response, "get") else None
+    return usage.get("total_tokens", usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)) if usage else None
+
+def create_embedding(input, engine: str):
+    # openai.Embedding.create within the limits of the deployment
+    texts = input if isinstance(input, list) else [input]
+    return call("embeddings", lambda: openai.Embedding.create(input=input, engine=engine), engine,
+                tokens=estimate_tokens(texts), used_tokens=response_tokens)
+
+def create_chat_completion(engine: str, messages: list, tokens: int = None):
+    # openai.ChatCompletion.create within the limits of the deployment (tokens: input tokens of the messages, if known)
+    if tokens is None:
+        tokens = estimate_tokens([message["content"] for message in messages])
+    return call("chat", lambda: openai.ChatCompletion.create(engine=engine, messages=messages), engine,
+                tokens=tokens, used_tokens=response_tokens)
+
+def analyze_document(document_analysis_client, model_id: str, document: bytes):
+    # result of Azure AI Document Intelligence for the document
+    # (only starting the analysis is retried: each started analysis is billed, polling its result is retried by the client itself)
+    poller = call("document_analysis", lambda: document_analysis_client.begin_analyze_document(model_id, document=document))
+    return poller.result()
+
+async def create_embedding_async(input, engine: str):
+    texts = input if isinstance(input, list) else [input]
+    return await call_async("embeddings", lambda: openai.Embedding.acreate(input=input, engine=engine), engine,
+                            tokens=estimate_tokens(texts), used_tokens=response_tokens)
+
+async def create_chat_completion_async(engine: str, messages: list, tokens: int = None):
+    if tokens is None:
+        tokens = estimate_tokens([message["content"] for message in messages])
+    return await call_async("chat", lambda: openai.ChatCompletion.acreate(engine=engine, messages=messages), engine,
+                            tokens=tokens, used_tokens=response_tokens)
+
+async def analyze_document_async(document_analysis_client, model_id: str, document: bytes):
+    # document_analysis_client from azure.ai.formrecognizer.aio
+    poller = await call_async("document_analysis", lambda: document_analysis_client.begin_analyze_document(model_id, document=document))
+    return await poller.result()
@@ -0,0 +1,145 @@
+#### Imports
+from PyPDF2 import PdfReader, PdfWriter
+import pdfplumber
+import io
+import threading
+import time
+import os
+import multiprocessing
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Large documents are parsed by several processes (text extraction is pure Python and CPU-bound),
+# all documents of the app share one pool of PDF_PARSING_WORKERS processes
+PDF_PARSING_WORKERS = int(os.environ.get("PDF_PARSING_WORKERS", os.cpu_count() or 1))
+# Documents with fewer pages are parsed in the current process (starting worker processes would take longer)
+PDF_PARSING_MIN_PAGES = int(os.environ.get("PDF_PARSING_MIN_PAGES", 50))
+
+def parse_pages(data: bytes, first: int, last: int) -> dict:
+    # Parse pages with index first to last-1 of a PDF (runs in a worker process for large documents)
+    parsed = {"page_texts": [], "page_seconds": [], "page_chars": [], "page_char_texts": [], "page_fontnames": [], "page_sizes": []}
+
+    # Text of each page as extracted by PyPDF2 (used to find templates and their header information)
+    pdf_reader = PdfReader(io.BytesIO(data))
+    for i in range(first, last):
+        start = time.perf_counter()
+        parsed["page_texts"].append(pdf_reader.pages[i].extract_text())
+        parsed["page_seconds"].append(time.perf_counter() - start)
+
+    # Characters of each page with style information (used to find questions and answers)
+    with pdfplumber.open(io.BytesIO(data)) as pdf:
+        for i in range(first, last):
+            start = time.perf_counter()
+            page = pdf.pages[i]
+            chars = []
+            fontname_dict = {}
+            size_dict = {}
+
+            for char in page.chars:
+                fontname = char["fontname"]
+                size = round(char["size"])
+                chars.append({"text": char["text"], "fontname": fontname, "size": size, "page_number": char["page_number"]})
+                fontname_dict[fontname] = fontname_dict.get(fontname, 0) + 1
+                size_dict[size] = size_dict.get(size, 0) + 1
+
+            parsed["page_chars"].append(chars)
+            parsed["page_char_texts"].append("".join(char["text"] for char in chars))
+            parsed["page_fontnames"].append(fontname_dict)
+            parsed["page_sizes"].append(size_dict)
+
+            # free memory of the parsed page objects, only the extracted characters are kept
+            page.flush_cache()
+
+            parsed["page_seconds"][i-first] += time.perf_counter() - start
+
+    return parsed
+
+_parsing_pool = None
+_parsing_pool_lock = threading.Lock()
+
+def parsing_pool() -> ProcessPoolExecutor:
+    # pool of worker processes for parsing, created on first use and shared by all threads (jobs, batch files) of the process.
+    # Worker processes are spawned instead of forked: forking a process with running threads (Streamlit, job workers) can deadlock.
+    global _parsing_pool
+    with _parsing_pool_lock:
+        if _parsing_pool is None:
+            _parsing_pool = ProcessPoolExecutor(max_workers=PDF_PARSING_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _parsing_pool
+
+def discard_parsing_pool(pool: ProcessPoolExecutor):
+    # shut down a pool with a dead worker process (e.g. killed when it ran out of memory), the next document gets a new pool
+    global _parsing_pool
+    with _parsing_pool_lock:
+        if _parsing_pool is pool:
+            _parsing_pool = None
+    pool.shutdown(wait=False)
+
+class ParsedDocument:
+    # PDF upload that is parsed only once and then shared by template detection and the extraction of all templates.
+    # Lists of the parsed document start at index 0, PDF page numbers start at 1 --> page i is found at index i-1
+
+    def __init__(self, data: bytes, workers: int = PDF_PARSING_WORKERS):
+        self.data = data
+        self._pdf_reader = PdfReader(io.BytesIO(data))
+        self._pdf_reader_lock = threading.Lock()
+        self.page_count = len(self._pdf_reader.pages)
+
+        # text (PyPDF2) and characters with style information (pdfplumber) of each page,
+        # and the time needed to parse each page (to find out where time goes for large documents)
+        self.page_texts = []
+        self.page_seconds = []
+        self.page_chars = []
+        self.page_char_texts = []
+        self.page_fontnames = []
+        self.page_sizes = []
+
+        if workers > 1 and self.page_count >= PDF_PARSING_MIN_PAGES:
+            # split pages into one consecutive range per worker, results are put together in the order of the pages
+            chunk_size = -(-self.page_count // workers)
+            ranges = [(first, min(first + chunk_size, self.page_count)) for first in range(0, self.page_count, chunk_size)]
+            pool = parsing_pool()
+            try:
+                parsed_ranges = list(pool.map(parse_pages, [data] * len(ranges), [first for first, last in ranges], [last for first, last in ranges]))
+            except BrokenProcessPool:
+                traceback.print_exc()
+                discard_parsing_pool(pool)
+                parsed_ranges = [parse_pages(data, 0, self.page_count)]
+        else:
+            parsed_ranges = [parse_pages(data, 0, self.page_count)]
+
+        for parsed in parsed_ranges:
+            self.page_texts.extend(parsed["page_texts"])
+            self.page_seconds.extend(parsed["page_seconds"])
+            self.page_chars.extend(parsed["page_chars"])
+            self.page_char_texts.extend(parsed["page_char_texts"])
+            self.page_fontnames.extend(parsed["page_fontnames"])
+            self.page_sizes.extend(parsed["page_sizes"])
+
+    def font_statistics(self, first_page: int, last_page: int):
+        # number of characters per font name and per (rounded) font size on pages first_page to last_page (inclusive)
+        fontname_dict = {}
+        size_dict = {}
+        for i in range(first_page-1, last_page):
+            for fontname, count in self.page_fontnames[i].items():
+                fontname_dict[fontname] = fontname_dict.get(fontname, 0) + count
+            for size, count in self.page_sizes[i].items():
+                size_dict[size] = size_dict.get(size, 0) + count
+
+        return fontname_dict, size_dict
+
+    def slowest_pages(self, count: int = 5) -> list:
+        # (page number, seconds) of the pages that took longest to parse
+        slowest = sorted(range(self.page_count), key=lambda i: self.page_seconds[i], reverse=True)[:count]
+        return [(i+1, self.page_seconds[i]) for i in slowest]
+
+    def page_pdf(self, page_number: int) -> bytes:
+        # single page of the document as standalone PDF (e.g. to send only this page to Document Intelligence)
+        # (PdfReader is not thread-safe, templates are extracted in parallel)
+        with self._pdf_reader_lock:
+            pdf_writer = PdfWriter()
+            pdf_writer.add_page(self._pdf_reader.pages[page_number-1])
+            buffer = io.BytesIO()
+            pdf_writer.write(buffer)
+
+        return buffer.getvalue()
@@ -0,0 +1,159 @@
+#### Imports
+import os
+import json
+import sqlite3
+import threading
+import time
+from cache import CACHE_DIR
+
+# Prices in euros: Document Intelligence (custom model) per analysed page, embeddings per embedded text
+# and LLM per 1000 prompt / completion tokens of each deployment (JSON, e.g. {"my-deployment": [0.0014, 0.0019]};
+# every deployment used by the validation rules needs a price, see validation.LLM_ENGINES)
+DOCUMENT_PAGE_PRICE = float(os.environ.get("DOCUMENT_PAGE_PRICE", 0.046817))
+EMBEDDING_PRICE = float(os.environ.get("EMBEDDING_PRICE", 0.00005))
+LLM_PRICES = {
+    "gpt-4": [0.028, 0.056],
+    "gpt-4-32k": [0.056, 0.112],
+    "gpt-35-turbo": [0.0014, 0.0019],
+    "gpt-35-turbo-16k": [0.0028, 0.0037]
+}
+LLM_PRICES.update(json.loads(os.environ.get("LLM_PRICES", "{}")))
+
+# Number of past runs the estimate is based on
+ESTIMATE_HISTORY_RUNS = int(os.environ.get("ESTIMATE_HISTORY_RUNS", 20))
+
+# Usage per template page assumed before any runs have been recorded (an average template has about 5 pages).
+# The prior counts like PRIOR_PAGES pages (PRIOR_TEMPLATES templates) of history, so a few unusual runs do not throw the estimate off.
+PRIOR_RATES = {
+    "document_pages_per_template": 1.0,  # custom extraction is only used on the first page of each template
+    "embeddings_per_page": 4.0,
+    "llm_euros_per_page": 0.014,
+    "seconds_per_page": 6.0
+}
+PRIOR_PAGES = 20
+PRIOR_TEMPLATES = 4
+
+def template_pages(template_list: list) -> int:
+    # number of pages of all templates (page ranges from find_templates_in_pdf, end page included)
+    return sum(template["end_page"] - template["start_page"] + 1 for template in template_list)
+
+def llm_price(engine: str) -> list:
+    if engine not in LLM_PRICES:
+        raise ValueError("No price for LLM deployment {} (add it to LLM_PRICES)".format(engine))
+    return LLM_PRICES[engine]
+
+def llm_costs(metrics: list) -> dict:
+    # billed tokens and euros of all LLM requests of a run (metrics of the validation rules, see validation.py)
+    costs = {"prompt_tokens": 0, "completion_tokens": 0, "llm_euros": 0.0}
+    for entry in metrics:
+        if entry.get("engine") is None:
+            # (basic rules and LLM checks without a request, no tokens billed)
+            continue
+        prompt_price, completion_price = llm_price(entry["engine"])
+        costs["prompt_tokens"] += entry["prompt_tokens"]
+        costs["completion_tokens"] += entry["completion_tokens"]
+        costs["llm_euros"] += (entry["prompt_tokens"] * prompt_price + entry["completion_tokens"] * completion_price) / 1000
+    return costs
+
+def billed_usage(billed: list) -> dict:
+    # total billed requests of a run (entries added by the pipeline, e.g. {"embeddings": 16} or {"document_pages": 1})
+    return {
+        "document_pages": sum(entry.get("document_pages", 0) for entry in billed),
+        "embeddings": sum(entry.get("embeddings", 0) for entry in billed)
+    }
+
+class UsageHistory:
+    # Usage of past runs (stored in SQLite next to the caches): size of the run, billed usage, actual and predicted
+    # costs and duration. Used to estimate costs and duration of new runs.
+
+    def __init__(self, path: str = os.path.join(CACHE_DIR, "usage_history.sqlite")):
+        self.path = path
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS runs (
+                created REAL, file_hash TEXT, template_count INTEGER, page_count INTEGER,
+                document_pages INTEGER, embeddings INTEGER, prompt_tokens INTEGER, completion_tokens INTEGER, llm_euros REAL,
+                predicted_euros REAL, actual_euros REAL, predicted_seconds REAL, actual_seconds REAL)""")
+            self._connection.commit()
+        return self._connection
+
+    def runs(self, limit: int = ESTIMATE_HISTORY_RUNS) -> list:
+        # most recent runs first
+        with self._lock:
+            connection = self._connect()
+            cursor = connection.execute("SELECT * FROM runs ORDER BY created DESC LIMIT ?", (limit,))
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def rates(self) -> dict:
+        # usage per template / page of the recent runs, combined with the prior
+        runs = self.runs()
+        templates = sum(run["template_count"] for run in runs)
+        pages = sum(run["page_count"] for run in runs)
+        return {
+            "document_pages_per_template": (PRIOR_RATES["document_pages_per_template"] * PRIOR_TEMPLATES + sum(run["document_pages"] for run in runs)) / (PRIOR_TEMPLATES + templates),
+            "embeddings_per_page": (PRIOR_RATES["embeddings_per_page"] * PRIOR_PAGES + sum(run["embeddings"] for run in runs)) / (PRIOR_PAGES + pages),
+            "llm_euros_per_page": (PRIOR_RATES["llm_euros_per_page"] * PRIOR_PAGES + sum(run["llm_euros"] for run in runs)) / (PRIOR_PAGES + pages),
+            "seconds_per_page": (PRIOR_RATES["seconds_per_page"] * PRIOR_PAGES + sum(run["actual_seconds"] for run in runs)) / (PRIOR_PAGES + pages)
+        }
+
+    def estimate(self, template_list: list) -> dict:
+        # predicted costs (euros) and duration (seconds) of extracting and validating the given templates
+        template_count = len(template_list)
+        page_count = template_pages(template_list)
+        rates = self.rates()
+
+        euros = template_count * rates["document_pages_per_template"] * DOCUMENT_PAGE_PRICE + \
+                page_count * rates["embeddings_per_page"] * EMBEDDING_PRICE + \
+                page_count * rates["llm_euros_per_page"]
+
+        return {
+            "template_count": template_count,
+            "page_count": page_count,
+            "euros": euros,
+            "seconds": page_count * rates["seconds_per_page"]
+        }
+
+    def record(self, template_list: list, estimate: dict, seconds: float, billed: list, metrics: list, file_hash: str = None, resumed: list = None) -> dict:
+        # store the actual usage of a finished run (billed requests of the run, see run_pipeline) and return it next to the prediction
+        # (a run that continued from checkpoints is returned, but not stored: its usage and duration only cover part of the
+        # templates, and would make the estimates of later runs too low)
+        usage = billed_usage(billed)
+        document_pages = usage["document_pages"]
+        embeddings = usage["embeddings"]
+
+        costs = llm_costs(metrics)
+
+        actual = {
+            "created": time.time(),
+            "file_hash": file_hash,
+            "template_count": len(template_list),
+            "page_count": template_pages(template_list),
+            "document_pages": document_pages,
+            "embeddings": embeddings,
+            "prompt_tokens": costs["prompt_tokens"],
+            "completion_tokens": costs["completion_tokens"],
+            "llm_euros": costs["llm_euros"],
+            "predicted_euros": estimate["euros"],
+            "actual_euros": document_pages * DOCUMENT_PAGE_PRICE + embeddings * EMBEDDING_PRICE + costs["llm_euros"],
+            "predicted_seconds": estimate["seconds"],
+            "actual_seconds": seconds
+        }
+
+        if resumed:
+            return actual
+
+        with self._lock:
+            connection = self._connect()
+            connection.execute("INSERT INTO runs ({}) VALUES ({})".format(", ".join(actual), ", ".join("?" * len(actual))), list(actual.values()))
+            connection.commit()
+
+        return actual
+
+usage_history = UsageHistory()
@@ -0,0 +1,232 @@
+#### Imports
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from cache import CACHE_DIR, cache_statistics, cache_statistics_delta, format_cache_statistics
+from clients import client_statistics, client_statistics_delta, format_client_statistics, create_document_analysis_client
+from utils import find_templates_in_pdf, generate_question_embeddings, QuestionLabeller, validation_results_to_excel, result_cache
+from pipeline import run_pipeline
+from async_pipeline import run_pipeline_in_event_loop, ASYNC_PIPELINE
+from document import ParsedDocument
+from estimation import usage_history
+from validation import summarize_metrics
+
+# Number of jobs (uploaded files) that are processed at the same time, shared by all users of the app
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+# Finished jobs (with their PDF file and workbook) are deleted after this many seconds
+JOB_RETENTION = float(os.environ.get("JOB_RETENTION", 7 * 24 * 60 * 60))
+# Seconds between two looks for new jobs of an idle worker
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 1))
+
+JOB_COLUMNS = ["id", "owner", "file_name", "file_hash", "status", "created", "started", "finished",
+               "template_count", "extracted", "validated", "progress_text", "message", "summary"]
+
+class JobQueue:
+    # Uploaded files are validated as jobs by background worker threads, independent of the Streamlit script run
+    # (a browser refresh or a lost connection does not interrupt the work). The state of all jobs is stored in SQLite,
+    # jobs that were running when the app stopped are queued again on the next start.
+    # Jobs of several users are scheduled fairly: the next job is taken from the user with the fewest running jobs
+    # (and, among those, the user who has waited longest since the start of their last job).
+
+    def __init__(self, path: str = os.path.join(CACHE_DIR, "jobs.sqlite"), workers: int = JOB_WORKERS):
+        self.path = path
+        self.workers = workers
+        self._connection = None
+        self._lock = threading.Lock()
+        self._new_job = threading.Event()
+        self._question_labeller = None
+        # documents parsed by the page before the job was submitted (only kept in memory, jobs queued again after a restart parse their file)
+        self._documents = {}
+        self._threads = []
+
+    def _connect(self):
+        if self._connection is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, owner TEXT, file_name TEXT, file_hash TEXT, status TEXT,
+                created REAL, started REAL, finished REAL, template_count INTEGER, extracted INTEGER, validated INTEGER,
+                progress_text TEXT, message TEXT, summary TEXT, data BLOB, result BLOB)""")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+            self._connection.commit()
+        return self._connection
+
+    def _update(self, job_id: str, **fields):
+        with self._lock:
+            connection = self._connect()
+            connection.execute("UPDATE jobs SET {} WHERE id = ?".format(", ".join(name + " = ?" for name in fields)), list(fields.values()) + [job_id])
+            connection.commit()
+
+    def submit(self, owner: str, file_name: str, data: bytes, file_hash: str, document: ParsedDocument = None) -> str:
+        # queue a new job for the file, unless the same file is already queued, running or done (then that job is returned)
+        # document: the file parsed already (e.g. for the estimate), so the worker does not parse it again
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT id FROM jobs WHERE file_hash = ? AND status IN ('queued', 'running', 'done') ORDER BY created DESC LIMIT 1", (file_hash,)).fetchone()
+            if row is not None:
+                return row[0]
+
+            job_id = uuid.uuid4().hex
+            connection.execute("INSERT INTO jobs (id, owner, file_name, file_hash, status, created, extracted, validated, data) VALUES (?, ?, ?, ?, 'queued', ?, 0, 0, ?)",
+                               (job_id, owner, file_name, file_hash, time.time(), data))
+            connection.commit()
+            if document is not None:
+                self._documents[job_id] = document
+
+        self._new_job.set()
+        return job_id
+
+    def get(self, job_id: str) -> dict:
+        # state of the job (without PDF file and workbook), None if there is no such job
+        # (retryable: the uploaded file is still stored, so a failed job can be queued again)
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT {}, data IS NOT NULL FROM jobs WHERE id = ?".format(", ".join(JOB_COLUMNS)), (job_id,)).fetchone()
+        return dict(zip(JOB_COLUMNS + ["retryable"], row)) if row is not None else None
+
+    def result(self, job_id: str) -> bytes:
+        # workbook of a finished job
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def queue_position(self, job_id: str) -> int:
+        # number of queued jobs that have been submitted before the job
+        with self._lock:
+            connection = self._connect()
+            return connection.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created < (SELECT created FROM jobs WHERE id = ?)", (job_id,)).fetchone()[0]
+
+    def retry(self, job_id: str):
+        # queue a failed job again (templates finished before the failure are not processed again)
+        with self._lock:
+            connection = self._connect()
+            connection.execute("UPDATE jobs SET status = 'queued', extracted = 0, validated = 0, progress_text = NULL, message = NULL WHERE id = ? AND status = 'failed' AND data IS NOT NULL", (job_id,))
+            connection.commit()
+        self._new_job.set()
+
+    def _next_job(self) -> str:
+        # claim the next queued job (fair between users), None if no job is waiting
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("""SELECT id FROM jobs AS queued_job WHERE status = 'queued'
+                ORDER BY (SELECT COUNT(*) FROM jobs AS running_job WHERE running_job.owner = queued_job.owner AND running_job.status = 'running'),
+                         (SELECT COALESCE(MAX(started), 0) FROM jobs AS started_job WHERE started_job.owner = queued_job.owner),
+                         created
+                LIMIT 1""").fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (time.time(), row[0]))
+            connection.commit()
+            return row[0]
+
+    def _cleanup(self):
+        # delete old finished jobs and queue jobs again that were interrupted (called before the workers start)
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished < ?", (time.time() - JOB_RETENTION,))
+            connection.execute("UPDATE jobs SET status = 'queued', extracted = 0, validated = 0, progress_text = NULL WHERE status = 'running'")
+            connection.commit()
+
+    def start(self):
+        # start the background workers (once per app process)
+        self._cleanup()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job_id = self._next_job()
+            if job_id is None:
+                self._new_job.wait(JOB_POLL_INTERVAL)
+                self._new_job.clear()
+                continue
+
+            try:
+                self._process(job_id)
+            except Exception as e:
+                traceback.print_exc()
+                # (the uploaded file is kept, so the job can be retried; finished templates are checkpointed by the pipeline)
+                self._update(job_id, status="failed", finished=time.time(), message=str(e))
+
+    def _process(self, job_id: str):
+        # extract and validate all templates of the uploaded file and store the workbook
+        with self._lock:
+            connection = self._connect()
+            file_hash, data = connection.execute("SELECT file_hash, data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+        with self._lock:
+            document = self._documents.pop(job_id, None)
+        if document is None:
+            document = ParsedDocument(data)
+        template_list = find_templates_in_pdf(document)
+        template_count = len(template_list)
+        if template_count == 0:
+            self._update(job_id, status="failed", finished=time.time(), message="No SFDR templates found in the provided document.", data=None)
+            return
+
+        estimate = usage_history.estimate(template_list)
+        self._update(job_id, template_count=template_count)
+
+        # (cache and request statistics are counted for the whole app, with several jobs running at the same time
+        # they include the other jobs; billed usage is counted for this job only)
+        cache_statistics_before = cache_statistics()
+        client_statistics_before = client_statistics()
+        start_time = time.perf_counter()
+
+        billed = []
+        resumed = []
+
+        # Generate embeddings of question variables for labelling of extracted paragraphs (once, shared by all jobs;
+        # embeddings that were not cached are billed to the job that needed them first)
+        if self._question_labeller is None:
+            self._question_labeller = QuestionLabeller(generate_question_embeddings(billed))
+
+        # Progress of both stages (templates are validated while other templates are still extracted)
+        def show_extraction_progress(i, done):
+            self._update(job_id, extracted=done)
+
+        def show_validation_progress(i, done):
+            self._update(job_id, validated=done, progress_text="Validated data from " + template_list[i]["f_product_name"] + "...")
+
+        # Extract and validate data from each template (with ASYNC_PIPELINE on an event loop of this worker instead of a thread per request)
+        if ASYNC_PIPELINE:
+            tempys, template_checks, metrics = run_pipeline_in_event_loop(template_list, document, lambda **kwargs: create_document_analysis_client(asynchronous=True, **kwargs),
+                                                                          self._question_labeller, on_extracted=show_extraction_progress,
+                                                                          on_validated=show_validation_progress, file_hash=file_hash, billed=billed, resumed=resumed)
+        else:
+            tempys, template_checks, metrics = run_pipeline(template_list, document, create_document_analysis_client(), self._question_labeller,
+                                                            on_extracted=show_extraction_progress, on_validated=show_validation_progress, file_hash=file_hash, billed=billed, resumed=resumed)
+
+        output = validation_results_to_excel(tempys, template_checks)
+        result_cache.set(file_hash, output)
+
+        # Record actual against predicted usage (improves the estimate of later runs)
+        actual = usage_history.record(template_list, estimate, time.perf_counter() - start_time, billed, metrics, file_hash, resumed)
+        run_statistics = cache_statistics_delta(cache_statistics_before)
+
+        # Run summary (costs and duration, cache hits and misses, time and tokens of each validation rule of this run)
+        summary = "Run summary:"
+        summary += "\n- Costs: {:0.2f} € (estimated {:0.2f} €)".format(actual["actual_euros"], actual["predicted_euros"])
+        summary += "\n- Duration: {:0.0f} s (estimated {:0.0f} s)".format(actual["actual_seconds"], actual["predicted_seconds"])
+        if resumed:
+            summary += "\n- Continued from {} checkpoint(s) of an earlier run (costs and duration of this part only, not used for estimates)".format(len(resumed))
+        summary += "\n- Billed: {} page(s) analyzed by Document Intelligence, {} text(s) embedded".format(actual["document_pages"], actual["embeddings"])
+        for line in format_cache_statistics(run_statistics) + format_client_statistics(client_statistics_delta(client_statistics_before)):
+            summary += "\n- " + line
+        summary += "\n- Slowest pages to parse: " + ", ".join("page {} ({:0.2f} s)".format(page, seconds) for page, seconds in document.slowest_pages())
+        for rule_id, total in summarize_metrics(metrics).items():
+            summary += "\n- Rule {} ({}): {:0.2f} s".format(rule_id, total["name"], total["seconds"])
+            if total["llm_requests"] > 0:
+                summary += ", {}: {} input tokens ({} answer(s) trimmed), {} prompt / {} completion tokens billed, {} of {} LLM answer(s) from cache".format(
+                    " / ".join(total["engines"]), total["input_tokens"], total["trimmed"], total["prompt_tokens"], total["completion_tokens"],
+                    total["cache_hits"], total["llm_requests"])
+
+        # (the uploaded file is not needed anymore)
+        self._update(job_id, status="done", finished=time.time(), result=output, summary=summary, data=None)
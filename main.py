@@ -1,13 +1,41 @@
 import streamlit as st
-import pandas as pd
 import os
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.formrecognizer import DocumentAnalysisClient
-from utils import find_templates_in_pdf, estimate_costs, generate_question_embeddings, extract_template_data, template_checks_to_excel, change_excel_design
-from validation import validate
+import hashlib
+import time
+import traceback
+import uuid
+from utils import find_templates_in_pdf, result_cache
+from document import ParsedDocument
+from estimation import usage_history
+from jobs import JobQueue
+
+# Seconds between two looks at the state of a job
+JOB_REFRESH_INTERVAL = float(os.environ.get("JOB_REFRESH_INTERVAL", 1))
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def parse_document(data: bytes) -> ParsedDocument:
+    # parsed document is kept between reruns of the script (e.g. after clicking "Start")
+    return ParsedDocument(data)
+
+@st.cache_resource(show_spinner=False)
+def get_job_queue() -> JobQueue:
+    # one job queue with its background workers per app process (shared by all users of the app)
+    job_queue = JobQueue()
+    job_queue.start()
+    return job_queue
 
 # $ streamlit run /workspaces/sfdr-validation-streamlit/Hello.py --server.enableXsrfProtection false
 
+def show_download_button(placeholder, output: bytes):
+    placeholder.download_button(
+      label="📥 Download validation results",
+      data=output,
+      file_name="validation_results.xlsx",
+      type="primary",
+      use_container_width=True,
+      mime = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
+
 def run():
   st.set_page_config(
       page_title="SFDR Template Validation",
@@ -16,9 +44,12 @@ def run():
 
   st.write("# SFDR Template Validation")
 
-  # Initialize session state
-  if "file_results" not in st.session_state:
-      st.session_state.file_results = {}
+  job_queue = get_job_queue()
+
+  # User and job are kept in the URL, so a refresh of the page (or a new connection) shows the job again
+  if "user" not in st.query_params:
+      st.query_params["user"] = uuid.uuid4().hex
+  owner = st.query_params["user"]
 
   uploaded_file = st.file_uploader("Please select a PDF file that contains SFDR templates")
   text_placeholder = st.empty()
@@ -28,113 +59,105 @@ def run():
   download_button_placeholder = st.empty()
 
   if uploaded_file is not None:
+      # Results are cached by content of the uploaded file (shared by all users of the app)
+      file_hash = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+
+      # (a job of another file is not shown anymore once a new file is uploaded)
+      if "job" in st.query_params:
+          job = job_queue.get(st.query_params["job"])
+          if job is None or job["file_hash"] != file_hash:
+              del st.query_params["job"]
+
+  if uploaded_file is not None and "job" not in st.query_params:
       text_placeholder.empty()
       start_button_placeholder.empty()
       extraction_progress_bar_placeholder.empty()
       download_button_placeholder.empty()
       validation_progress_bar_placeholder.empty()
-    
-      if uploaded_file.name in st.session_state.file_results:
-        output = st.session_state.file_results[uploaded_file.name]
-        
-        download_button_placeholder.download_button(
-          label="📥 Download validation results",
-          data=output,
-          file_name="validation_results.xlsx",
-          type="primary",
-          use_container_width=True,
-          mime = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
-        
+
+      output = result_cache.get(file_hash)
+
+      if output is not None:
+
+        show_download_button(download_button_placeholder, output)
+
       else:
         with st.spinner("Working..."):
-          # Read PDF documents with PyPDF to find starts of templates
-          template_list = find_templates_in_pdf(uploaded_file)
-    
+          # Parse PDF document once (shared by template detection and data extraction) and find starts of templates
+          # (a document that cannot be read is reported as such, not as a document without templates)
+          error = None
+          try:
+              document = parse_document(uploaded_file.getvalue())
+              template_list = find_templates_in_pdf(document)
+          except Exception as e:
+              traceback.print_exc()
+              error = e
+              template_list = []
+
           template_count = len(template_list)
-            
-          if template_count == 0:
+
+          if error is not None:
+            text_placeholder.markdown("The provided document could not be read: {}".format(error))
+          elif template_count == 0:
             text_placeholder.markdown("No SFDR templates found in the provided document.")
           else:
             #st.markdown(str(template_count) + " template(s) found in the provided document.")
-            estimated_costs = estimate_costs(template_count)
-            #st.markdown("\nEstimated cost for extraction and validation is {:0.2f} €.\n".format(estimated_costs))
-            text_placeholder.markdown(str(template_count) + " template(s) found in the provided document. \nEstimated cost for extraction and validation is {:0.2f} €.\n".format(estimated_costs))
+            # Estimate from the page ranges of the templates and the usage of past runs
+            estimate = usage_history.estimate(template_list)
+            #st.markdown("\nEstimated cost for extraction and validation is {:0.2f} €.\n".format(estimate["euros"]))
+            text_placeholder.markdown(str(template_count) + " template(s) found in the provided document. \nEstimated cost for extraction and validation is {:0.2f} € and estimated duration is {:0.0f} s.\n".format(estimate["euros"], estimate["seconds"]))
 
             if start_button_placeholder.button("Start", type="primary", use_container_width=True):
-                # TODO hide button after click
                 text_placeholder.empty()
                 start_button_placeholder.empty()
-          
-                # Create dataframe to store extraction results
-                template_fields = pd.DataFrame()
-          
-                # Set up Azure AI Document Intelligence
-                try:
-                    document_ai_endpoint = os.environ["DOCUMENT_AI_ENDPOINT"]
-                    document_ai_key = os.environ["DOCUMENT_AI_KEY"]
-                except:
-                    document_ai_endpoint = st.secrets["DOCUMENT_AI_ENDPOINT"]
-                    document_ai_key = st.secrets["DOCUMENT_AI_KEY"]
-                    
-          
-                document_analysis_client = DocumentAnalysisClient(
-                    endpoint=document_ai_endpoint, credential=AzureKeyCredential(document_ai_key)
-                )
-          
-                # Generate embeddings of question variables for labelling of extracted paragraphs
-                question_variables = generate_question_embeddings()
-          
-                extraction_bar = extraction_progress_bar_placeholder.progress(0, text="Extracting data...")
-          
-                # Extract data from template
-                for i, template in enumerate(template_list):
-          
-                    # Show progress
-                    extraction_bar.progress(((i+1)/template_count), text="Extracting data from " + template["f_product_name"] + "...")
-          
-                    template_data = extract_template_data(template, uploaded_file, document_analysis_client, question_variables)
-          
-                    #Save all results from this template to dataframe
-                    id = template_data["f_legal_entity_identifier"]
-                    for k,v in template_data.items():
-                        if type(v) == dict: # -> q_n_a_pairs
-                            key = v["label"]
-                            try: 
-                                # there might be multiple answers to one label
-                                existing_value = template_fields.at[key, id]
-                                template_fields.at[key, id] = existing_value + " / " + v["answer"]
-                            except:
-                                template_fields.at[key, id] = v["answer"]
-                        else:
-                            template_fields.at[k, id] = v
-          
-                validation_bar = validation_progress_bar_placeholder.progress(0, text="Validating data...")
-          
-                template_checks = {}
-          
-                # Validate extracted data from each template
-                tempys = template_fields.transpose()
-          
-                for i, index in enumerate(tempys.index):
-                    validation_bar.progress(((i+1)/len(tempys.index)), text="Validating data from " + tempys.at[index, "f_product_name"] + "...")
-                    id = tempys.at[index,"f_legal_entity_identifier"]
-                    validation_results = validate(tempys, index)
-                    template_checks[id] = validation_results
-          
-                sheet = template_checks_to_excel(tempys, template_checks)
-                output = change_excel_design(sheet)
-                st.session_state.file_results[uploaded_file.name] = output
-                st.balloons()
-
-                download_button_placeholder.download_button(
-                    label="📥 Download validation results",
-                    data=output,
-                    file_name="validation_results.xlsx",
-                    type="primary",
-                    use_container_width=True,
-                    mime = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+
+                # Extraction and validation run in the background (see jobs.py), this script only shows the state of the job
+                st.query_params["job"] = job_queue.submit(owner, uploaded_file.name, uploaded_file.getvalue(), file_hash, document)
+
+  if "job" in st.query_params:
+      job_id = st.query_params["job"]
+      watched = False
+
+      while True:
+          job = job_queue.get(job_id)
+          if job is None:
+              # (finished jobs are deleted after some days)
+              del st.query_params["job"]
+              text_placeholder.markdown("The validation results are not available anymore, please upload the file again.")
+              break
+
+          if job["status"] == "queued":
+              text_placeholder.markdown("Waiting for other validations to finish ({} job(s) ahead of {})...".format(job_queue.queue_position(job_id), job["file_name"]))
+          elif job["status"] == "running":
+              text_placeholder.markdown("Validating {}...".format(job["file_name"]))
+              if job["template_count"]:
+                  # Show progress of both stages (templates are validated while other templates are still extracted)
+                  extraction_progress_bar_placeholder.progress(job["extracted"] / job["template_count"], text="Extracted data from {} of {} template(s)...".format(job["extracted"], job["template_count"]))
+                  validation_progress_bar_placeholder.progress(job["validated"] / job["template_count"], text=job["progress_text"] or "Validating data...")
+          elif job["status"] == "failed":
+              extraction_progress_bar_placeholder.empty()
+              validation_progress_bar_placeholder.empty()
+              text_placeholder.markdown("Validation of {} failed: {}".format(job["file_name"], job["message"]))
+              if not job["retryable"]:
+                  del st.query_params["job"]
+                  break
+              # a retry continues with the templates that were not finished before the failure
+              if not start_button_placeholder.button("Retry", type="primary", use_container_width=True):
+                  break
+              # (polled by a new run of the script, the Retry button must not be shown twice in the same run)
+              job_queue.retry(job_id)
+              st.rerun()
+          else:
+              extraction_progress_bar_placeholder.empty()
+              validation_progress_bar_placeholder.empty()
+              if watched:
+                  st.balloons()
+              show_download_button(download_button_placeholder, job_queue.result(job_id))
+              text_placeholder.markdown(job["summary"])
+              break
+
+          watched = True
+          time.sleep(JOB_REFRESH_INTERVAL)
 
 if __name__ == "__main__":
     run()
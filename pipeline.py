@@ -0,0 +1,158 @@
+#### Imports
+import os
+import json
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils import extract_template_data, build_template_fields
+from validation import validate_basic_conditions, validate_advanced_conditions
+from cache import SQLiteCache, hash_key
+
+# Number of templates that are extracted at the same time (limited to stay within Azure rate quotas)
+EXTRACTION_WORKERS = int(os.environ.get("EXTRACTION_WORKERS", 4))
+# Number of templates that are validated at the same time (each of them sends several GPT-4 requests in parallel)
+VALIDATION_WORKERS = int(os.environ.get("VALIDATION_WORKERS", 2))
+
+# Checkpoints of finished templates: extracted data and validation results, stored as soon as a template is done
+# (keyed by SHA-256 of the document, legal entity identifier and start page(s) of the template(s)). A run that failed part way
+# (e.g. an error of a GPT-4 or Document Intelligence request) only processes the unfinished templates when it is retried.
+checkpoint_cache = SQLiteCache("checkpoints",
+                               max_entries=int(os.environ.get("CHECKPOINT_CACHE_SIZE", 5000)),
+                               ttl=float(os.environ.get("CHECKPOINT_TTL", 7 * 24 * 60 * 60)))
+
+def template_groups(template_list) -> list:
+    # indices of all templates with the same identifier as each template (as found by find_templates_in_pdf)
+    # (templates with the same identifier are merged into one row of the table and validated together)
+    groups = {}
+    for i, template in enumerate(template_list):
+        groups.setdefault(template["f_legal_entity_identifier"], []).append(i)
+    return [groups[template["f_legal_entity_identifier"]] for template in template_list]
+
+def checkpoint_keys(file_hash: str, template_list) -> list:
+    # keys of the extraction and validation checkpoints of each template (None without file_hash)
+    # (computed before the extraction, which adds fields to the templates; the validation checkpoint is shared by all
+    # templates with the same identifier)
+    if file_hash is None:
+        return [{"extraction": None, "validation": None} for template in template_list]
+    keys = []
+    for template, group in zip(template_list, template_groups(template_list)):
+        id = template["f_legal_entity_identifier"]
+        start_pages = ",".join(str(template_list[j]["start_page"]) for j in group)
+        keys.append({"extraction": hash_key(file_hash, "extraction", id, template["start_page"]),
+                     "validation": hash_key(file_hash, "validation", id, start_pages)})
+    return keys
+
+def load_checkpoint(key: str, resumed: list = None):
+    # (keys of loaded checkpoints are added to resumed, if given)
+    if key is None:
+        return None
+    cached = checkpoint_cache.get(key)
+    if cached is None:
+        return None
+    if resumed is not None:
+        resumed.append(key)
+    return json.loads(cached)
+
+def save_checkpoint(key: str, value):
+    if key is not None:
+        checkpoint_cache.set(key, json.dumps(value, default=str).encode("utf-8"))
+
+def validate_template_data(template_data_list: list, metrics: list = None) -> list:
+    # check advanced validation conditions (LLM) of the templates of one identifier once all of them are extracted,
+    # using a one-row table with the same layout as the full table
+    template_fields = build_template_fields(template_data_list)
+    return validate_advanced_conditions(template_fields, template_data_list[0]["f_legal_entity_identifier"], metrics)
+
+def extract_template_checkpointed(template, document, document_analysis_client, question_labeller, keys: dict, billed: list = None, resumed: list = None):
+    template_data = load_checkpoint(keys["extraction"], resumed)
+    if template_data is None:
+        # (extracted into a copy, the templates of template_list stay as found in the document)
+        template_data = extract_template_data(dict(template), document, document_analysis_client, question_labeller, billed)
+        save_checkpoint(keys["extraction"], template_data)
+    return template_data
+
+def validate_template_checkpointed(template_data_list: list, keys: dict, metrics: list = None, resumed: list = None) -> list:
+    conditions = load_checkpoint(keys["validation"], resumed)
+    if conditions is None:
+        conditions = validate_template_data(template_data_list, metrics)
+        save_checkpoint(keys["validation"], conditions)
+    return conditions
+
+def run_pipeline(template_list, document, document_analysis_client, question_labeller, on_extracted=None, on_validated=None, file_hash: str = None, billed: list = None, resumed: list = None):
+    # Extract and validate all templates as a streaming pipeline: each template is validated as soon as its extraction
+    # has finished (together with the other templates of its identifier), while other templates are still being extracted.
+    # on_extracted / on_validated are called with (template index, number of finished templates) from the calling thread,
+    # so they can be used to update Streamlit elements.
+    # With file_hash (SHA-256 of the document), each finished template is checkpointed and templates finished by an earlier
+    # run are not processed again. If a template fails, all other templates are still finished (and checkpointed)
+    # before the first error is raised.
+    # Billed requests of this run (embedded texts and pages analyzed by Document Intelligence) are added to billed (if given),
+    # keys of the checkpoints this run continued from are added to resumed (if given).
+    # Returns the table of extracted fields, the validation results and the metrics of all validation rules (see validation.py).
+    template_count = len(template_list)
+    extracted_templates = [None] * template_count
+    validation_results = [None] * template_count
+    extracted_count = 0
+    validated_count = 0
+    metrics = []
+    error = None
+    groups = template_groups(template_list)
+    keys = checkpoint_keys(file_hash, template_list)
+
+    with ThreadPoolExecutor(max_workers=EXTRACTION_WORKERS) as extraction_executor, ThreadPoolExecutor(max_workers=VALIDATION_WORKERS) as validation_executor:
+        pending = {}
+        for i, template in enumerate(template_list):
+            future = extraction_executor.submit(extract_template_checkpointed, template, document, document_analysis_client, question_labeller, keys[i], billed, resumed)
+            pending[future] = ("extraction", i)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                stage, i = pending.pop(future)
+
+                if future.exception() is not None:
+                    traceback.print_exception(type(future.exception()), future.exception(), future.exception().__traceback__)
+                    if error is None:
+                        error = future.exception()
+                    continue
+
+                if stage == "extraction":
+                    extracted_templates[i] = future.result()
+                    extracted_count += 1
+                    if all(extracted_templates[j] is not None for j in groups[i]):
+                        group_data = [extracted_templates[j] for j in groups[i]]
+                        pending[validation_executor.submit(validate_template_checkpointed, group_data, keys[i], metrics, resumed)] = ("validation", i)
+                    if on_extracted is not None:
+                        on_extracted(i, extracted_count)
+                else:
+                    for j in groups[i]:
+                        validation_results[j] = future.result()
+                        validated_count += 1
+                        if on_validated is not None:
+                            on_validated(j, validated_count)
+
+    if error is not None:
+        raise error
+
+    return merge_results(extracted_templates, validation_results, metrics, groups)
+
+def merge_results(extracted_templates: list, validation_results: list, metrics: list, groups: list):
+    # Merge results in the order of the templates in the document (one row per identifier)
+    tempys = build_template_fields(extracted_templates)
+
+    # basic validation conditions are checked for all templates at once
+    basic_conditions = validate_basic_conditions(tempys, metrics)
+
+    extracted_groups = {}
+    for i, template_data in enumerate(extracted_templates):
+        extracted_groups.setdefault(template_data["f_legal_entity_identifier"], []).append(i)
+
+    template_checks = {}
+    for id, indices in extracted_groups.items():
+        conditions = validation_results[indices[0]]
+        if indices != groups[indices[0]]:
+            # (the identifier of a template was changed by its extraction, the merged row has not been validated yet)
+            conditions = validate_advanced_conditions(tempys, id, metrics)
+        template_checks[id] = basic_conditions[id] + conditions
+
+    return tempys, template_checks, metrics
@@ -1,12 +1,12 @@
 #### Imports
-from PyPDF2 import PdfReader
 import openai
-import pdfplumber
 import numpy as np
 from numpy.linalg import norm
 import json
 import pandas as pd
-from openpyxl import load_workbook
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.worksheet.cell_range import MultiCellRange
 from openpyxl.styles import Alignment
 from openpyxl.styles import PatternFill
 from openpyxl.formatting.rule import CellIsRule
@@ -15,6 +15,12 @@ from openpyxl.styles import Border, Side
 import os
 import streamlit as st
 import io
+import re
+import bisect
+import math
+from copy import copy
+from cache import SQLiteCache, hash_key
+from clients import create_embedding, analyze_document
 
 # Set up open AI
 try:
@@ -28,99 +34,145 @@ except:
     openai.api_base = st.secrets["OPENAI_API_BASE"]
     openai.api_version = st.secrets["OPENAI_API_VERSION"]
 
+# Cache for embeddings of questions (keyed by model and text)
+EMBEDDING_ENGINE = "text-embedding-ada-002"
+embedding_cache = SQLiteCache("embeddings", max_entries=int(os.environ.get("EMBEDDING_CACHE_SIZE", 20000)))
+
+def embedding_to_bytes(embedding: list) -> bytes:
+    return np.asarray(embedding, dtype=np.float32).tobytes()
+
+def embedding_from_bytes(value: bytes) -> list:
+    return np.frombuffer(value, dtype=np.float32).tolist()
+
+# Cache for fields extracted by Azure AI Document Intelligence (keyed by model and content of the analyzed page)
+DOCUMENT_MODEL_ID = "sfdr_template_extraction_paid_version_only_1_page"
+document_fields_cache = SQLiteCache("document_fields", max_entries=int(os.environ.get("DOCUMENT_FIELDS_CACHE_SIZE", 5000)))
+
+# Cache for finished validation workbooks (keyed by SHA-256 of the uploaded PDF), shared by all sessions of the app
+result_cache = SQLiteCache("results",
+                           max_entries=int(os.environ.get("RESULT_CACHE_SIZE", 100)),
+                           max_bytes=int(os.environ.get("RESULT_CACHE_MAX_BYTES", 500 * 1024 * 1024)),
+                           persist=os.environ.get("RESULT_CACHE_PERSIST", "0") == "1")
+
+# Azure OpenAI accepts at most 16 inputs per embedding request
+EMBEDDING_BATCH_SIZE = 16
+
 # Functions
-def generate_embeddings(text: str) -> list:
-    response = openai.Embedding.create(
-        input=text, engine="text-embedding-ada-002")
-    embeddings = response['data'][0]['embedding']
+def cached_embeddings(texts: list):
+    # cached embedding of each text (None if not cached) and positions of the texts that are not cached (each text once)
+    embeddings = [None] * len(texts)
+    missing = {}
+    for i, text in enumerate(texts):
+        cached = embedding_cache.get(hash_key(EMBEDDING_ENGINE, text))
+        if cached is not None:
+            embeddings[i] = embedding_from_bytes(cached)
+        else:
+            missing.setdefault(text, []).append(i)
+    return embeddings, missing
+
+def store_embeddings(batch: list, response, missing: dict, embeddings: list):
+    # the API reports the position of each input in the batch, results are not guaranteed to be ordered
+    for item in response['data']:
+        text = batch[item['index']]
+        embedding_cache.set(hash_key(EMBEDDING_ENGINE, text), embedding_to_bytes(item['embedding']))
+        for i in missing[text]:
+            embeddings[i] = item['embedding']
+
+def generate_embeddings_batch(texts: list, batch_size: int = EMBEDDING_BATCH_SIZE, billed: list = None) -> list:
+    # embed all texts with as few requests as possible; result i always belongs to texts[i]
+    # (cached embeddings are looked up first, only texts not seen before are sent to the API)
+    # the number of embedded texts of each request is added to billed (if given)
+    embeddings, missing = cached_embeddings(texts)
+
+    missing_texts = list(missing.keys())
+    for start in range(0, len(missing_texts), batch_size):
+        batch = missing_texts[start:start+batch_size]
+        response = create_embedding(batch, EMBEDDING_ENGINE)
+        store_embeddings(batch, response, missing, embeddings)
+        if billed is not None:
+            billed.append({"embeddings": len(batch)})
+
     return embeddings
 
-def estimate_costs(template_count: int) -> float:
-    avg_validation_cost_per_template = 0.07
-    custom_extraction_cost_per_page = 0.046817 # with this approach, custom extraction is only used on one page per document -> cost savings
-    embedding_costs_per_template = 0.001
+# Start of a template: reference to the SFDR regulation on the first page (matched on lower case text)
+TEMPLATE_START_PATTERN = re.compile(re.escape("asetuksen (eu) 2019/2088"))
+# Header information on the first page of a template: text after the first marker up to the end marker
+# (or up to the next occurrence of the first marker / the end of the page if there is no end marker)
+TEMPLATE_ARTICLE_PATTERN = re.compile(r"2088((?:(?!2088|artiklan).)*)", re.DOTALL)
+PRODUCT_NAME_PATTERN = re.compile(r"Tuotenimi((?:(?!Tuotenimi|Oikeushenkilö).)*)", re.DOTALL)
+LEGAL_ENTITY_IDENTIFIER_PATTERN = re.compile(r"tunnus((?:(?!tunnus|Ympäristöön).)*)", re.DOTALL)
+
+def find_template_start_pages(document) -> list:
+    # indexes of all pages that contain the start of a template, found with one scan over the text of the whole document
+    # (pages are separated by a character that is not part of the pattern, so matches never span two pages)
+    page_texts = [text.lower() for text in document.page_texts]
+    page_offsets = []
+    position = 0
+    for text in page_texts:
+        page_offsets.append(position)
+        position += len(text) + 1
+
+    start_pages = []
+    for match in TEMPLATE_START_PATTERN.finditer("\f".join(page_texts)):
+        i = bisect.bisect_right(page_offsets, match.start()) - 1
+        if len(start_pages) == 0 or start_pages[-1] != i:
+            start_pages.append(i)
+
+    return start_pages
+
+def parse_template_header(text: str, i: int) -> dict:
+    # Find f_template_article, product name, legal identity code in the text of the first page of a template
+    match = TEMPLATE_ARTICLE_PATTERN.search(text)
+    try:
+        f_template_article = int(match.group(1).strip())
+    except:
+        f_template_article = None
 
-    total_costs = (avg_validation_cost_per_template + custom_extraction_cost_per_page + embedding_costs_per_template) * template_count
-    
-    return total_costs
+    match = PRODUCT_NAME_PATTERN.search(text)
+    f_product_name = match.group(1).replace(":","").strip() if match else None
+
+    match = LEGAL_ENTITY_IDENTIFIER_PATTERN.search(text)
+    if match:
+        # (legal entity identifier is always 20 digits long; if it is longer, something went wrong in the extraction)
+        f_legal_entity_identifier = match.group(1).replace(":","").strip()[:20]
+    elif f_product_name != None:
+        # identifier needed for saving and validation
+        f_legal_entity_identifier = f_product_name
+    else:
+        f_legal_entity_identifier = "no_name_found_" + str(i)
+
+    return {
+        "f_template_article": f_template_article,
+        "f_product_name": f_product_name,
+        "f_legal_entity_identifier": f_legal_entity_identifier
+    }
 
-def find_templates_in_pdf(uploaded_file) -> list:
+def find_templates_in_pdf(document) -> list:
     try:
-        pdf_reader = PdfReader(uploaded_file)
-        pages = pdf_reader.pages
-        num_pages = len(pages)
+        start_pages = find_template_start_pages(document)
         templates = []
-        i = 0
-        last_start_page = 0
-        
-        # Define all variables that we want to extract (from the first page)
-        f_template_article = None
-        f_product_name = None
-        f_legal_entity_identifier = None
-
-        while i < num_pages:
-            page = pages[i]
-            text = page.extract_text()
-            
-            if "asetuksen (eu) 2019/2088" in text.lower():
-                # if there has been a previous start page, a new start page means the end of the previous template
-                # -> save and reset extracted variables
-                if last_start_page != 0:
-                    template = {
-                        "start_page": last_start_page,
-                        "end_page": i,
-                        "f_template_article": f_template_article,
-                        "f_product_name": f_product_name,
-                        "f_legal_entity_identifier": f_legal_entity_identifier
-                    }
-                    templates.append(template)
-
-                    # Reset variables
-                    f_template_article = None
-                    f_product_name = None
-                    f_legal_entity_identifier = None
-            
-                # Split text of the first page of the template to find f_template_article, product name, legal identity code
-                text = page.extract_text()
-                try:
-                    f_template_article = int(text.split("2088")[1].split("artiklan")[0].strip())
-                except:
-                    f_template_article = None
-                try:
-                    f_product_name = text.split("Tuotenimi")[1].split("Oikeushenkilö")[0].replace(":","").strip()
-                except:
-                    f_product_name = None
-                try:
-                    # (legal entity identifier is always 20 digits long; if it is longer, something went wrong in the extraction)
-                    f_legal_entity_identifier = text.split("tunnus")[1].split("Ympäristöön")[0].replace(":","").strip()[:20]
-                except:
-                    # identifier needed for saving and validation
-                    if f_product_name != None:
-                        f_legal_entity_identifier = f_product_name
-                    else:
-                        f_legal_entity_identifier = "no_name_found_" + str(i)
-
-                last_start_page = i+1
-            i += 1
-                
-        # add information of last template in PDF to list
-        if last_start_page != 0:
+
+        for n, i in enumerate(start_pages):
+            # a template ends on the page before the next template starts (last template ends with the document)
+            if n < len(start_pages)-1:
+                end_page = start_pages[n+1]
+            else:
+                end_page = document.page_count
+
             template = {
-                "start_page": last_start_page,
-                "end_page": num_pages,
-                "f_template_article": f_template_article,
-                "f_product_name": f_product_name,
-                "f_legal_entity_identifier": f_legal_entity_identifier
+                "start_page": i+1,
+                "end_page": end_page
             }
-            templates.append(template) 
+            template.update(parse_template_header(document.page_texts[i], i))
+            templates.append(template)
 
         return templates
     
     except:
         return []
 
-def generate_question_embeddings():
-    # Define variables for questions (preparation for labelling)
+def generate_question_embeddings(billed: list = None):
+    # Define variables for questions (preparation for labelling), embedded texts that were not cached are added to billed (if given)
     question_variables = {
         "a_promoted_e_s_characteristics": "Mitä ympäristöön ja/tai yhteiskuntaan littyviä ominaisuuksia tämä rahoitustuote edistää?",
         "a_sustainability_indicators_used": "Mitä kestävyysindikaattoreita käytetään mittaamaan kunkun tämän rahoitustuotteen edistämän ympäristöön tai yhteiskuntaan littyvän ominaisuuden toteutumista?",
@@ -143,54 +195,88 @@ def generate_question_embeddings():
         "a_specific_index_benchmark": "Onko tietty indeksi nimetty vertailuarvoksi, jotta voidaanmäärittää, vastaako tämä rahoitustuote edistämiään ympäristöön ja/tai yhteiskuntaan liittyviä ominaisuuksia?",
         "a_product_information_online": "Mistä voin saada tarkempia tuotekohtaisia tietoja verkossa?"
     }
-    # generate embedding for each question variable
-    for key, value in question_variables.items():
-        emb = generate_embeddings(value)
+    # generate embeddings for all question variables in one batch
+    keys = list(question_variables.keys())
+    embeddings = generate_embeddings_batch([question_variables[key] for key in keys], billed=billed)
+    for key, emb in zip(keys, embeddings):
         question_variables[key] = emb
     
     return question_variables
 
-def extract_template_data(template, uploaded_file, document_analysis_client, question_variables):
+class QuestionLabeller:
+    # Labels extracted questions with the most similar question variable.
+    # The question variable embeddings are normalized once and kept as one matrix, so all questions
+    # of a template are scored with a single matrix multiplication.
+
+    def __init__(self, question_variables: dict):
+        self.labels = list(question_variables.keys())
+        matrix = np.array([question_variables[key] for key in self.labels], dtype=np.float64)
+        self.matrix = matrix / norm(matrix, axis=1, keepdims=True)
+
+    def label(self, question_embeddings: list) -> list:
+        # returns (label, cosine similarity) of the best matching question variable for each embedding
+        if len(question_embeddings) == 0:
+            return []
+
+        embeddings = np.array(question_embeddings, dtype=np.float64)
+        embeddings = embeddings / norm(embeddings, axis=1, keepdims=True)
+        scores = embeddings @ self.matrix.T
+
+        # argmax keeps the first label on ties, like the previous loop over question variables did
+        best = scores.argmax(axis=1)
+        return [(self.labels[j], float(scores[i, j])) for i, j in enumerate(best)]
+
+def find_answer(text: str, question: str, next_question, start: int, end: int) -> str:
+    # Answer to a question is the text after the first occurrence of the question in text[start:end], up to the next question
+    # (or up to a repetition of the question itself, or to the end if neither follows)
+    question_position = text.find(question, start, end)
+    if question_position == -1:
+        raise IndexError("Question not found in text of the template: " + question)
+    answer_start = question_position + len(question)
+
+    answer_end = text.find(question, answer_start, end)
+    if answer_end == -1:
+        answer_end = end
+
+    if next_question is not None:
+        next_question_position = text.find(next_question, answer_start, answer_end)
+        if next_question_position != -1:
+            answer_end = next_question_position
+
+    return text[answer_start:answer_end].strip()
+
+def find_questions_and_answers(template, document) -> dict:
     # Get list of all paragraphs in a template with style information
     paragraph_list = []
-    pages_text = {}
-    fontname_dict = {}
-    size_dict = {}
-
-    with pdfplumber.open(uploaded_file) as pdf: 
-        current_paragraph = ""
-        paragraph_fontname = None
-        paragraph_size = None
-        page_number = None
-
-        # Consider all pages from template
-        # PDF page numbers start at 1 but pdf.pages starts with index 0 --> start_page -1
-        for i in range(template["start_page"]-1, template["end_page"]):
-
-            page = pdf.pages[i]
-            page_text = ""
-
-            for char in page.chars:
-                page_text += char["text"]   
-                fontname = char["fontname"]
-                fontname_dict[fontname] = fontname_dict.get(fontname, 0) + 1
-                size = round(char["size"])
-                size_dict[size] = size_dict.get(size, 0) + 1
-
-                if (fontname == paragraph_fontname) & (size == paragraph_size):
-                    current_paragraph += char["text"]
-                else:
-                    if current_paragraph != "":
-                        paragraph_list.append({"text": current_paragraph.strip(), "fontname": paragraph_fontname, "size": paragraph_size, "page": page_number})
-                    current_paragraph = char["text"]
-                    paragraph_fontname = fontname
-                    paragraph_size = size
-                    page_number = char["page_number"]
 
-            if current_paragraph != "":
-                paragraph_list.append({"text": current_paragraph.strip(), "fontname": paragraph_fontname, "size": paragraph_size, "page": page_number})
+    # characters of the current paragraph are collected in a list and only joined when the paragraph is saved
+    current_paragraph = []
+    paragraph_fontname = None
+    paragraph_size = None
+    page_number = None
 
-            pages_text[page.page_number] = page_text
+    # Consider all pages from template (characters of the document have been parsed once for all templates)
+    for i in range(template["start_page"], template["end_page"]+1):
+
+        for char in document.page_chars[i-1]:
+            fontname = char["fontname"]
+            size = char["size"]
+
+            if (fontname == paragraph_fontname) & (size == paragraph_size):
+                current_paragraph.append(char["text"])
+            else:
+                if len(current_paragraph) > 0:
+                    paragraph_list.append({"text": "".join(current_paragraph).strip(), "fontname": paragraph_fontname, "size": paragraph_size, "page": page_number})
+                current_paragraph = [char["text"]]
+                paragraph_fontname = fontname
+                paragraph_size = size
+                page_number = char["page_number"]
+
+        # (paragraph is saved at the end of each page but continues on the next page if the style does not change)
+        if len(current_paragraph) > 0:
+            paragraph_list.append({"text": "".join(current_paragraph).strip(), "fontname": paragraph_fontname, "size": paragraph_size, "page": page_number})
+
+    fontname_dict, size_dict = document.font_statistics(template["start_page"], template["end_page"])
 
     # Select all paragraphs that are bold and contain a questionmark
     question_list = []
@@ -205,212 +291,266 @@ def extract_template_data(template, uploaded_file, document_analysis_client, que
             if not "onko tällä rahoitustuotteella kestävä sijoitustavoite" in paragraph["text"].lower():
                 question_list.append(paragraph)
 
+    # Text of all pages of the template in one string, pages are separated by white space
+    # (text starts with white space to ensure that the start of the text is never equal to a question)
+    # page_start / page_end: position of the first character of a page and position after the white space following the page
+    page_start = {}
+    page_end = {}
+    text_parts = [" "]
+    position = 1
+    for i in range(template["start_page"], template["end_page"]+1):
+        page_text = document.page_char_texts[i-1]
+        page_start[i] = position
+        position += len(page_text) + 1
+        page_end[i] = position
+        text_parts.append(page_text)
+        text_parts.append(" ")
+    template_text = "".join(text_parts)
+
     # Get all text between two questions as associated answers
     q_n_a_pairs = {}
 
-    for i in range(len(question_list)-1):
-
-        # get text split between current question and next question
-        start_question = question_list[i]["text"]
-        stop_question = question_list[i+1]["text"]
+    for i in range(len(question_list)):
 
         # only consider relevant pages of the template to reduce risk of wrong splitting (sometimes questions are refered to in answer to other question)
+        # -> from the page of the current question to the page of the next question; last answer is everything from last question to end of template
+        question = question_list[i]["text"]
         first_page = question_list[i]["page"]
-        last_page = question_list[i+1]["page"]
-
-        relevant_text = " " # relevant text starts with white space to ensure that the start of the relevant text is never equal to the start question, so that the the answer will always be in split[1], not split[0]
-        for j in range(first_page, last_page+1):
-            relevant_text += pages_text[j] + " "
-
-        answer = relevant_text.split(start_question)[1].split(stop_question)[0].strip()
 
-        q_n_a_pairs[start_question] = answer
+        if i < len(question_list)-1:
+            next_question = question_list[i+1]["text"]
+            last_page = question_list[i+1]["page"]
+        else:
+            next_question = None
+            last_page = template["end_page"]
 
-    # get answer for last question
-    last_question = question_list[len(question_list)-1]["text"]
-    first_page = question_list[len(question_list)-1]["page"]
-    last_page = template["end_page"]
+        q_n_a_pairs[question] = find_answer(template_text, question, next_question, page_start[first_page]-1, page_end[last_page])
 
-    relevant_text = " "
-    for j in range(first_page, last_page+1):
-        relevant_text += pages_text[j] + " "
+    return q_n_a_pairs
 
-    answer = relevant_text.split(last_question)[1].strip() # last answer is everything from last question to end of template
+def add_question_labels(template, q_n_a_pairs: dict, question_embeddings: list, question_labeller):
+    for question, (label, cosine) in zip(q_n_a_pairs.keys(), question_labeller.label(question_embeddings)):
 
-    q_n_a_pairs[last_question] = answer
+        # each question gets the label of the most similar question variable
+        #if cosine > 0.85: # TODO: no treshhold here? get a label for each extracted q_n_a pair and then check later which can be used
+        if cosine > 0:
+            # (this way it is possible that multiple questions have the same label --> keep in mind for validation)
+            template[question] = {"label": label, "answer": q_n_a_pairs[question], "cosine": cosine}
 
-    # Match questions (and answers) with variables of interested for template validation using embeddddings
-    # generate and match embedding for each extracted question with question variable embeddings
-    for question, answer in q_n_a_pairs.items():
+def store_document_fields(key: str, result) -> dict:
+    # labeled fields of the Document Intelligence result (cached by page content)
+    fields = {}
+    for analyzed_document in result.documents:
+        for k, v in analyzed_document.fields.items():
+            fields[k] = v.value
 
-        quest_emb = generate_embeddings(question)
+    # (values are returned as stored, e.g. dates as strings, so a page gives the same fields with or without the cache)
+    stored = json.dumps(fields, default=str).encode("utf-8")
+    document_fields_cache.set(key, stored)
+    return json.loads(stored)
 
-        for key, value in question_variables.items():
+def extract_template_data(template, document, document_analysis_client, question_labeller, billed: list = None):
+    # billed requests (embedded texts, analyzed pages) are added to billed (if given), see estimation.billed_usage
+    q_n_a_pairs = find_questions_and_answers(template, document)
 
-            # calculate cosine similarity between value and quest emb
-            cosine = np.dot(quest_emb,value)/(norm(quest_emb)*norm(value))
-            
-            # if variable above treshhold, add to template dict with cosine similarity; if already in dict, keep value with higher cosine similarity
-            #if cosine > 0.85: # TODO: no treshhold here? get a label for each extracted q_n_a pair and then check later which can be used
-            if cosine > 0:
-                # (this way it is possible that multiple questions have the same label --> keep in mind for validation)
-                current_value = template.get(question, {})
-                current_cosine = current_value.get("cosine",0)
+    # Match questions (and answers) with variables of interested for template validation using embeddddings
+    # generate embeddings for all extracted questions of the template at once and match them with question variable embeddings
+    question_embeddings = generate_embeddings_batch(list(q_n_a_pairs.keys()), billed=billed)
+    add_question_labels(template, q_n_a_pairs, question_embeddings, question_labeller)
 
-                if cosine > current_cosine:
-                    template[question] = {"label": key, "answer": answer, "cosine": cosine}
-    
     # Use Azure AI Document Intelligence to get labeled fields from table on first page ####################
     start_page = template["start_page"]
 
-    #with open(uploaded_file, "rb") as f:
-    poller = document_analysis_client.begin_analyze_document(
-        "sfdr_template_extraction_paid_version_only_1_page",
-        document=uploaded_file.getvalue(),
-        pages=start_page
-    )
-    result = poller.result()
+    # only the first page of the template is sent as a small standalone PDF (instead of the whole document)
+    page_pdf = document.page_pdf(start_page)
 
-    for document in result.documents:
-        for k, v in document.fields.items():
-            template[k] = v.value
+    # results are cached by page content, unchanged pages of a re-uploaded document are not analyzed again
+    key = hash_key(DOCUMENT_MODEL_ID, page_pdf)
+    cached = document_fields_cache.get(key)
 
-    return template
+    if cached is not None:
+        fields = json.loads(cached)
+    else:
+        fields = store_document_fields(key, analyze_document(document_analysis_client, DOCUMENT_MODEL_ID, page_pdf))
+        if billed is not None:
+            billed.append({"document_pages": 1})
 
-def template_checks_to_excel(tempys, template_checks):
-    #Export validation results into structured excel file
-    val_result_dfs = {}
-
-    for k,v in template_checks.items():
-        # write results to df
-        val_results = pd.DataFrame(None, [], ["name", "description", "value", "comment"])
-
-        for i in range(len(v)):
-            val_results.at[i, "name"] = v[i]["name"]
-            val_results.at[i, "description"] = v[i]["description"]
-            val_results.at[i, "value"] = v[i]["value"]
-            val_results.at[i, "comment"] = v[i]["comment"]
-
-        val_result_dfs[k] = val_results
-
-    # buffer to use for excel writer
-    buffer = io.BytesIO()
-
-    #with pd.ExcelWriter(filename) as writer:
-    with pd.ExcelWriter(buffer) as writer:
-        for k, df in val_result_dfs.items():
-            extracted_data = tempys[tempys["f_legal_entity_identifier"] == k].transpose()
-            if len(k) > 30: # excel sheet name cant be longer than 30 characters
-                k = k[len(k)-30:]
-            df.to_excel(writer, sheet_name=k, index=False)
-            extracted_data.to_excel(writer, sheet_name=k, header=[k], startrow=15)
-            
-    return buffer
-
-def change_excel_design(buffer):
-    
-    wb = load_workbook(buffer)
+    for k, v in fields.items():
+        template[k] = v
 
-    for ws in wb._sheets:
-        
-        # change column width
+    return template
+
+def template_data_to_row(template_data, row: dict = None) -> dict:
+    # Collect all results from a template in a plain dict (field / label -> value)
+    if row is None:
+        row = {}
+
+    for k,v in template_data.items():
+        if type(v) == dict: # -> q_n_a_pairs
+            key = v["label"]
+            # there might be multiple answers to one label
+            existing_value = row.get(key)
+            if type(existing_value) == str:
+                row[key] = existing_value + " / " + v["answer"]
+            else:
+                row[key] = v["answer"]
+        else:
+            row[k] = v
+
+    return row
+
+def build_template_fields(template_data_list: list) -> pd.DataFrame:
+    # Build the table of all templates at once (one row per legal entity identifier, one column per field / label)
+    rows = {}
+    for template_data in template_data_list:
+        id = template_data["f_legal_entity_identifier"]
+        # (results of templates with the same identifier are merged)
+        rows[id] = template_data_to_row(template_data, rows.get(id))
+
+    return pd.DataFrame.from_dict(rows, orient="index", dtype=object)
+
+# Layout of the validation results workbook (one sheet per template)
+VALIDATION_HEADER_ROW = 1
+CONDITIONS_HEADER_ROW = 2
+TEMPLATE_DATA_HEADER_ROW = 17
+# template data rows with value merged over columns B to D, table frame ends with the last of these rows
+MERGED_ROWS = range(18, 67)
+LAST_FRAMED_ROW = 66
+
+# Styles are created once and shared by all cells of all sheets
+medium_side = Side(border_style="medium", color="000000")
+center_alignment = Alignment(wrap_text=True, horizontal="center", vertical="center")
+cell_font = Font(size=11)
+column_header_font = Font(size=11, bold=True)
+section_header_font = Font(size=16, bold=True)
+no_border = Border()
+right_border = Border(right=medium_side)
+bottom_border = Border(bottom=medium_side)
+right_bottom_border = Border(right=medium_side, bottom=medium_side)
+top_bottom_border = Border(top=medium_side, bottom=medium_side)
+right_top_bottom_border = Border(top=medium_side, right=medium_side, bottom=medium_side)
+left_top_bottom_border = Border(top=medium_side, left=medium_side, bottom=medium_side)
+green_fill = PatternFill(start_color="92D050", end_color="92D050", fill_type="solid")
+red_fill = PatternFill(start_color="C00000", end_color="C00000", fill_type="solid")
+
+def cell_style(ws, border, font=None, alignment=None):
+    # style of a cell with the given border, font and alignment, registered in the workbook once
+    # and then copied to all cells with the same style (instead of looking up font, border and alignment for each cell)
+    cell = WriteOnlyCell(ws)
+    if font is not None:
+        cell.font = font
+    if alignment is not None:
+        cell.alignment = alignment
+    cell.border = border
+    return cell._style
+
+def excel_value(value):
+    # missing values are written as empty text (like pandas does)
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    return value
+
+def tab_color(values) -> str:
+    # green if all validations positive, red if all validations negative, yellow if at least 50 % positive, otherwise red
+    # (all values of the sheet are counted, not only the validation results)
+    true_count = sum(1 for value in values if not isinstance(value, str) and value == True)
+    false_count = sum(1 for value in values if not isinstance(value, str) and value == False)
+    if false_count == 0:
+        return "92D050"
+    elif true_count == 0:
+        return "C00000"
+    elif true_count / false_count >= 1:
+        return "FFC000"
+    else:
+        return "C00000"
+
+def validation_results_to_excel(tempys, template_checks) -> bytes:
+    # Export validation results and extracted data of each template into one sheet of an excel file.
+    # The sheets are written row by row in their final layout (write-only workbook, nothing is kept in memory or changed afterwards).
+    wb = Workbook(write_only=True)
+    styles = None
+
+    for k, conditions in template_checks.items():
+        # validation results (rows 3 to 15) and extracted data (rows 18 and following, one row per field)
+        condition_rows = [[condition["name"], condition["description"], condition["value"], condition["comment"]] for condition in conditions]
+        extracted_data = tempys[tempys["f_legal_entity_identifier"] == k].iloc[0]
+        data_rows = [[field, excel_value(value)] for field, value in extracted_data.items()]
+
+        values = [value for row in condition_rows + data_rows for value in row]
+        last_row = max(LAST_FRAMED_ROW + 1, TEMPLATE_DATA_HEADER_ROW + len(data_rows))
+
+        if len(k) > 30: # excel sheet name cant be longer than 30 characters
+            k = k[len(k)-30:]
+        ws = wb.create_sheet(k)
+
+        # sheet properties have to be set before the first row is written
         ws.column_dimensions['A'].width = 25
         ws.column_dimensions['B'].width = 100
         ws.column_dimensions['C'].width = 10
         ws.column_dimensions['D'].width = 50
+        ws.row_dimensions[VALIDATION_HEADER_ROW].height = 40
+        ws.row_dimensions[TEMPLATE_DATA_HEADER_ROW].height = 40
+        ws.sheet_properties.tabColor = tab_color(values)
 
-        # merge B (2) to D (4) for template data rows
-        for i in range(18,67):
-            ws.merge_cells(start_row=i, start_column=2, end_row=i, end_column=4)
-
-        # add conditional formatting for True / False
-        green_fill = PatternFill(start_color="92D050",end_color="92D050",fill_type="solid")
-        red_fill = PatternFill(start_color="C00000",end_color="C00000",fill_type="solid")
+        ws.merged_cells = MultiCellRange(["A{0}:D{0}".format(VALIDATION_HEADER_ROW), "A{0}:D{0}".format(TEMPLATE_DATA_HEADER_ROW)] +
+                                         ["B{0}:D{0}".format(i) for i in MERGED_ROWS])
 
+        # conditional formatting for True / False
         ws.conditional_formatting.add('C2:C15', CellIsRule(operator='equal', formula=["True"], fill=green_fill))
         ws.conditional_formatting.add('C2:C15', CellIsRule(operator='equal', formula=["False"], fill=red_fill))
-        
-        # style to add borders
-        border_style = Side(border_style="medium", color="000000")
-
-        true_count = 0
-        false_count = 0
-
-        for row in ws.iter_rows():
-            for cell in row:
-
-                # count true and false values (for tab formatting)
-                if cell.value == True:
-                    true_count += 1
-                elif cell.value == False:
-                    false_count += 1
-
-                # change text alignment
-                cell.alignment = Alignment(wrap_text=True, horizontal="center",vertical="center")
-                cell.font = Font(size=11)
-                cell.border = None
-
-                # add borders
-                if cell.row == 1:
-                    cell.font = Font(size=11, bold=True)
-                    if cell.column == 4:
-                        cell.border = Border(top=border_style, left=None, right=border_style, bottom=border_style)
-                    else:
-                        cell.border = Border(top=border_style, left=None, right=None, bottom=border_style)
-                elif cell.row == 65:
-                    if cell.column == 4:
-                        cell.border = Border(top=None, left=None, right=border_style, bottom=border_style)
-                    else:
-                        cell.border = Border(top=None, left=None, right=None, bottom=border_style)
-                elif (cell.column == 4) & (cell.row <= 65):
-                    cell.border = Border(top=None, left=None, right=border_style, bottom=None)
-
-        # add headers
-        # "VALIDATION"
-        ws.insert_rows(1)
-        ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=4)
-        cell = ws.cell(row=1, column=1)
-        cell.value = "VALIDATION"
-        cell.alignment = Alignment(wrap_text=True, horizontal="center",vertical="center")
-        cell.font = Font(size=16, bold=True)
-        cell.border = Border(top=border_style, left=border_style, right=None, bottom=border_style)
-        ws.cell(row=1, column=2).border = Border(top=border_style, left=None, right=None, bottom=border_style)
-        ws.cell(row=1, column=3).border = Border(top=border_style, left=None, right=None, bottom=border_style)
-        ws.cell(row=1, column=4).border = Border(top=border_style, left=None, right=border_style, bottom=border_style)
-        ws.row_dimensions[1].height = 40
-
-        # "TEMPLATE DATA"
-        ws.delete_rows(17)
-        ws.insert_rows(17)
-        ws.merge_cells(start_row=17, start_column=1, end_row=17, end_column=4)
-        cell = ws.cell(row=17, column=1)
-        cell.value = "TEMPLATE DATA"
-        cell.alignment = Alignment(wrap_text=True, horizontal="center",vertical="center")
-        cell.font = Font(size=16, bold=True)
-        cell.border = Border(top=border_style, left=border_style, right=None, bottom=border_style)
-        ws.cell(row=17, column=2).border = Border(top=border_style, left=None, right=None, bottom=border_style)
-        ws.cell(row=17, column=3).border = Border(top=border_style, left=None, right=None, bottom=border_style)
-        ws.cell(row=17, column=4).border = Border(top=border_style, left=None, right=border_style, bottom=border_style)
-        ws.row_dimensions[17].height = 40
-        
-        # Change tab color based on validation results
-        if false_count == 0:
-            # green if all validations positive
-            ws.sheet_properties.tabColor = "92D050"
-        elif true_count == 0:
-            # red if all validations negative
-            ws.sheet_properties.tabColor = "C00000" 
-        else:
-            ratio = true_count / false_count
-            # yellow if at least 50 % positive
-            if ratio >= 1:
-                ws.sheet_properties.tabColor = "FFC000"
+
+        if styles is None:
+            styles = {
+                "section_header": cell_style(ws, left_top_bottom_border, section_header_font, center_alignment),
+                "section_header_middle": cell_style(ws, top_bottom_border),
+                "section_header_right": cell_style(ws, right_top_bottom_border),
+                "column_header": cell_style(ws, top_bottom_border, column_header_font, center_alignment),
+                "column_header_right": cell_style(ws, right_top_bottom_border, column_header_font, center_alignment),
+                "cell": cell_style(ws, no_border, cell_font, center_alignment),
+                "cell_right": cell_style(ws, right_border, cell_font, center_alignment),
+                "cell_bottom": cell_style(ws, bottom_border, cell_font, center_alignment),
+                "cell_right_bottom": cell_style(ws, right_bottom_border, cell_font, center_alignment)
+            }
+
+        for i in range(1, last_row + 1):
+            if i in (VALIDATION_HEADER_ROW, TEMPLATE_DATA_HEADER_ROW):
+                # "VALIDATION" / "TEMPLATE DATA"
+                cell = WriteOnlyCell(ws, "VALIDATION" if i == VALIDATION_HEADER_ROW else "TEMPLATE DATA")
+                cell._style = copy(styles["section_header"])
+                row = [cell]
+                for column in range(2, 5):
+                    cell = WriteOnlyCell(ws)
+                    cell._style = copy(styles["section_header_right" if column == 4 else "section_header_middle"])
+                    row.append(cell)
+                ws.append(row)
+                continue
+
+            if i == CONDITIONS_HEADER_ROW:
+                row_values = ["name", "description", "value", "comment"]
+            elif i < TEMPLATE_DATA_HEADER_ROW and i-3 < len(condition_rows):
+                row_values = condition_rows[i-3]
+            elif i > TEMPLATE_DATA_HEADER_ROW and i-18 < len(data_rows):
+                row_values = data_rows[i-18]
             else:
-                # red if less than 50 % positive
-                ws.sheet_properties.tabColor = "C00000"
-           
+                row_values = []
+
+            row = []
+            for column in range(1, 5):
+                cell = WriteOnlyCell(ws, row_values[column-1] if column <= len(row_values) else None)
+
+                # text alignment, font and borders
+                if i == CONDITIONS_HEADER_ROW:
+                    style = "column_header_right" if column == 4 else "column_header"
+                elif i == LAST_FRAMED_ROW:
+                    style = "cell_right_bottom" if column == 4 else "cell_bottom"
+                else:
+                    style = "cell_right" if (column == 4) & (i < LAST_FRAMED_ROW) else "cell"
+                cell._style = copy(styles[style])
+                row.append(cell)
+            ws.append(row)
+
     file_buffer = io.BytesIO()
     wb.save(file_buffer)
     content = file_buffer.getvalue()
-        
+
     return content
@@ -1,256 +1,462 @@
-import openai
 import json
+import pandas as pd
+import os
+import math
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from cache import SQLiteCache, hash_key
+from clients import create_chat_completion, create_chat_completion_async
+from estimation import llm_price
+
+# tiktoken is optional: without it, tokens are estimated from the length of the text
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 def get_value(index, name, dataframe):
+    # missing values are returned as empty string, no matter if the column is missing or empty for this template
     try:
-        return str(dataframe.at[index, name])
+        value = dataframe.at[index, name]
     except:
         return ""
+    if value is None or (type(value) == float and math.isnan(value)):
+        return ""
+    return str(value)
 
-def validate(template_fields, i):
+# Number of LLM checks of one template that are sent to GPT-4 at the same time
+LLM_CHECK_WORKERS = int(os.environ.get("LLM_CHECK_WORKERS", 5))
 
-    # store validation results for current template
-    conditions = []
+# Ids of validation rules that are not checked (comma-separated, e.g. "6,15"); rules that depend on a skipped rule are skipped as well
+SKIPPED_RULES = [rule_id.strip() for rule_id in os.environ.get("SKIPPED_RULES", "").split(",") if rule_id.strip()]
+
+# Azure OpenAI deployment used for each check (JSON, e.g. {"3": "gpt-35-turbo"}), all other checks use LLM_ENGINE
+LLM_ENGINE = os.environ.get("LLM_ENGINE", "gpt-4")
+LLM_ENGINES = json.loads(os.environ.get("LLM_ENGINES", "{}"))
+# (fails on start instead of after a run if the costs of a deployment are not known)
+for engine in set(LLM_ENGINES.values()) | {LLM_ENGINE}:
+    llm_price(engine)
+
+# Maximum number of tokens of the answer text that is sent with the prompt of a check (JSON with budget per check, e.g. {"6": 3000},
+# all other checks use LLM_INPUT_TOKEN_BUDGET); longer answers are cut off at the end
+LLM_INPUT_TOKEN_BUDGET = int(os.environ.get("LLM_INPUT_TOKEN_BUDGET", 6000))
+LLM_INPUT_TOKEN_BUDGETS = json.loads(os.environ.get("LLM_INPUT_TOKEN_BUDGETS", "{}"))
+
+# Marks answers that have been cut off to fit the token budget
+TRIMMED_MARKER = " [...]"
+
+# Cache for GPT-4 answers: templates of the same manager often share identical boilerplate answers
+llm_cache = SQLiteCache("llm_responses",
+                        max_entries=int(os.environ.get("LLM_CACHE_SIZE", 20000)),
+                        ttl=float(os.environ.get("LLM_CACHE_TTL", 30 * 24 * 60 * 60)))
+
+def llm_engine(check_id: str) -> str:
+    return LLM_ENGINES.get(check_id, LLM_ENGINE)
+
+_token_encodings = []
+
+def token_encoding():
+    # (all deployments used by the app are GPT-3.5 / GPT-4 models that share the same encoding)
+    # tiktoken downloads the encoding on first use, if that is not possible tokens are estimated as well
+    if not _token_encodings:
+        try:
+            _token_encodings.append(tiktoken.get_encoding("cl100k_base"))
+        except Exception:
+            _token_encodings.append(None)
+    return _token_encodings[0]
+
+def count_tokens(text: str) -> int:
+    encoding = token_encoding()
+    if encoding is None:
+        # rule of thumb: one token is about four characters
+        return -(-len(text) // 4)
+    return len(encoding.encode(text))
+
+def trim_to_budget(text: str, budget: int) -> str:
+    # text cut off after budget tokens (unchanged if it is short enough)
+    if count_tokens(text) <= budget:
+        return text
+    encoding = token_encoding()
+    if encoding is None:
+        return text[:budget * 4] + TRIMMED_MARKER
+    return encoding.decode(encoding.encode(text)[:budget]) + TRIMMED_MARKER
+
+def build_prompt(check_id: str, system: str, text: str, engine: str = None) -> dict:
+    # deployment and messages of the request for the given check, with the answer text trimmed to the token budget of the check
+    budget = int(LLM_INPUT_TOKEN_BUDGETS.get(check_id, LLM_INPUT_TOKEN_BUDGET))
+    trimmed_text = trim_to_budget(text, budget)
+    return {
+        "engine": engine or llm_engine(check_id),
+        "messages": [
+            {"role": "system", "content": system},
+            {"role": "user", "content": trimmed_text}
+        ],
+        "input_tokens": count_tokens(system) + count_tokens(trimmed_text),
+        "trimmed": trimmed_text != text
+    }
+
+def cached_answer(check_id: str, system: str, text: str, engine: str = None, usage: dict = None):
+    # prompt, cache key and cached answer (None if the same request has not been made before) of an LLM request
+    # deployment, input tokens and cache status of the request are added to usage (if given)
+    prompt = build_prompt(check_id, system, text, engine)
+    text = prompt["messages"][1]["content"]
+
+    key = hash_key(check_id, system, text, prompt["engine"])
+    cached = llm_cache.get(key)
+    if usage is not None:
+        usage["cached"] = cached is not None
+        usage["engine"] = prompt["engine"]
+        usage["input_tokens"] += prompt["input_tokens"]
+        usage["trimmed"] = usage.get("trimmed", False) or prompt["trimmed"]
+    return prompt, key, json.loads(cached)["content"] if cached is not None else None
+
+def store_answer(key: str, response, usage: dict = None) -> str:
+    # answer of the LLM response, billed tokens are added to usage (if given)
+    resp = response['choices'][0]['message']['content']
+
+    if usage is not None and response.get("usage") is not None:
+        usage["prompt_tokens"] += response["usage"].get("prompt_tokens", 0)
+        usage["completion_tokens"] += response["usage"].get("completion_tokens", 0)
+
+    # (the checks parse the stored answer again, so the same result dict is restored on a cache hit)
+    llm_cache.set(key, json.dumps({"content": resp}).encode("utf-8"))
+
+    return resp
+
+def ask_gpt(check_id: str, system: str, text: str, engine: str = None, usage: dict = None) -> str:
+    # answer of the LLM for the given check, system prompt and text (from cache if the same request has been made before)
+    # deployment, token usage and cache status of the request are added to usage (if given)
+    prompt, key, answer = cached_answer(check_id, system, text, engine, usage)
+    if answer is not None:
+        return answer
+
+    response = create_chat_completion(prompt["engine"], prompt["messages"], prompt["input_tokens"])
+    return store_answer(key, response, usage)
+
+async def ask_gpt_async(check_id: str, system: str, text: str, engine: str = None, usage: dict = None) -> str:
+    # like ask_gpt, without blocking the event loop while waiting for the answer
+    prompt, key, answer = cached_answer(check_id, system, text, engine, usage)
+    if answer is not None:
+        return answer
+
+    response = await create_chat_completion_async(prompt["engine"], prompt["messages"], prompt["input_tokens"])
+    return store_answer(key, response, usage)
+
+def run_check(check, fields: dict, usage: dict, previous: dict = None) -> dict:
+    # run an LLM rule, its requests are answered one after the other
+    steps = check(fields, usage, previous)
+    try:
+        request = next(steps)
+        while True:
+            request = steps.send(ask_gpt(*request, usage=usage))
+    except StopIteration as stop:
+        return stop.value
+
+async def run_check_async(check, fields: dict, usage: dict, previous: dict = None) -> dict:
+    steps = check(fields, usage, previous)
+    try:
+        request = next(steps)
+        while True:
+            request = steps.send(await ask_gpt_async(*request, usage=usage))
+    except StopIteration as stop:
+        return stop.value
+
+#################### Validation engine ####################
+# runs the rules of the registry (RULES, see end of this file) and records wall time, token usage and cache status
+# of each rule for each template in metrics (list of dicts, if given)
+
+def active_rules(skipped: list = None) -> list:
+    # rules of the registry in their order, without skipped rules and rules depending on them
+    skipped = set(SKIPPED_RULES if skipped is None else skipped)
+    rules = []
+    for rule in RULES:
+        if rule["id"] in skipped or rule.get("depends_on") in skipped:
+            skipped.add(rule["id"])
+        else:
+            rules.append(rule)
+    return rules
+
+def required_fields(rules: list) -> list:
+    # input fields of the given rules (without duplicates, in the order of the rules)
+    fields = []
+    for rule in rules:
+        for field in rule["fields"]:
+            if field not in fields:
+                fields.append(field)
+    return fields
+
+def rule_metrics(template, rule, seconds: float, usage: dict = None) -> dict:
+    usage = usage or {}
+    return {
+        "template": template,
+        "rule": rule["id"],
+        "name": rule["name"],
+        "llm": rule["llm"],
+        "seconds": seconds,
+        "prompt_tokens": usage.get("prompt_tokens", 0),
+        "completion_tokens": usage.get("completion_tokens", 0),
+        "cached": usage.get("cached"),
+        "engine": usage.get("engine"),
+        "input_tokens": usage.get("input_tokens", 0),
+        "trimmed": usage.get("trimmed", False)
+    }
+
+def summarize_metrics(metrics: list) -> dict:
+    # totals per rule over all templates: {rule id: {"name", "runs", "seconds", "input_tokens", "prompt_tokens", "completion_tokens",
+    # "cache_hits", "llm_requests", "trimmed", "engines"}}
+    summary = {}
+    for entry in metrics:
+        total = summary.setdefault(entry["rule"], {"name": entry["name"], "runs": 0, "seconds": 0.0, "input_tokens": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                                                   "cache_hits": 0, "llm_requests": 0, "trimmed": 0, "engines": []})
+        total["runs"] += 1
+        total["seconds"] += entry["seconds"]
+        total["input_tokens"] += entry["input_tokens"]
+        total["prompt_tokens"] += entry["prompt_tokens"]
+        total["completion_tokens"] += entry["completion_tokens"]
+        total["trimmed"] += int(entry["trimmed"])
+        if entry["cached"] is not None:
+            total["llm_requests"] += 1
+            total["cache_hits"] += int(entry["cached"])
+        if entry["engine"] is not None and entry["engine"] not in total["engines"]:
+            total["engines"].append(entry["engine"])
+    return summary
+
+def validate_basic_conditions(template_fields, metrics: list = None) -> dict:
+    #################### Check for basic validation conditions ####################
+    # basic validation conditions are such conditions that can be simply answered with yes or no
+    # e.g., answer for specific questions has been provided and contains a numerical value
+    # -> checked for all templates (rows of template_fields) at once with string operations on whole columns
+    # returns the list of conditions for each index of template_fields
 
     # following validation steps only apply to Article 8 products (Article 9 template is slightly different)
     #if get_value("f_template_article",i) != "8":
         #continue
 
+    rules = [rule for rule in active_rules() if not rule["llm"]]
+
+    # Get required variables (missing values as empty string, like get_value)
+    fields = template_fields.reindex(columns=required_fields(rules))
+    fields = fields.astype(object).where(fields.notna(), "").astype(str)
+
+    # Save validation results
+    conditions = {index: [] for index in fields.index}
+    for rule in rules:
+        start = time.perf_counter()
+        value, comment = rule["check"](fields)
+        # (time of the rule is shared equally by all templates)
+        seconds = (time.perf_counter() - start) / max(len(fields.index), 1)
+
+        for row, index in enumerate(fields.index):
+            condition = {
+                "name": rule["name"],
+                "description": rule["description"],
+                "value": bool(value.iloc[row]),
+                "comment": comment.iloc[row]
+            }
+            conditions[index].append(condition)
+            if metrics is not None:
+                metrics.append(rule_metrics(index, rule, seconds))
+
+    return conditions
+
+def rule_chains(rules: list) -> list:
+    # rules are independent of each other and run at the same time, except for rules that depend on the result of
+    # another rule (e.g. 4. on 3.): these run one after the other in the same chain.
+    chains = []
+    for rule in rules:
+        chain = next((chain for chain in chains if rule.get("depends_on") in [r["id"] for r in chain]), None)
+        if chain is None:
+            chains.append([rule])
+        else:
+            chain.append(rule)
+    return chains
+
+def collect_conditions(i, rules: list, results: dict, rule_seconds: dict, rule_usage: dict, metrics: list = None) -> list:
+    # store validation results for current template (in the order of the registry)
+    conditions = []
+    for rule in rules:
+        result = results[rule["id"]]
+        condition = {
+            "name": rule["name"],
+            "description": rule["description"],
+            "value": result["value"],
+            "comment": result["comment"]
+        }
+        conditions.append(condition)
+        if metrics is not None:
+            metrics.append(rule_metrics(i, rule, rule_seconds[rule["id"]], rule_usage[rule["id"]]))
+
+    return conditions
+
+def validate_advanced_conditions(template_fields, i, metrics: list = None) -> list:
+    #################### Check for advanced validation conditions ####################
+    # advanced validation conditions are such conditions that require reasoning capabilities
+    # e.g., "The description should indicate whether the fund promotes E and S or both."
+    # the reasoning of a large language model (ChatGPT) is used for this task
+
+    rules = [rule for rule in active_rules() if rule["llm"]]
+
     # Get required variables
-    sm_sustainable_investment_object_yes = get_value(i,"sm_sustainable_investment_object_yes", template_fields)
-    sm_sustainable_investment_object_no = get_value(i,"sm_sustainable_investment_object_no", template_fields)
-    sm_environmental_objective = get_value(i,"sm_environmental_objective", template_fields)
-    sm_social_objective = get_value(i,"sm_social_objective", template_fields)
-    sm_minimum_sustainable_investment = get_value(i,"sm_minimum_sustainable_investment", template_fields)
-    sm_no_sustainable_investment = get_value(i,"sm_no_sustainable_investment", template_fields)
-    f_environmental_objective = get_value(i,"f_environmental_objective", template_fields)
-    f_social_objective = get_value(i,"f_social_objective", template_fields)
-    f_minimum_sustainable_investment = get_value(i,"f_minimum_sustainable_investment", template_fields)
-    f_taxonomy_do_not_harm_statement = get_value(i,"f_taxonomy_do_not_harm_statement", template_fields)
-    a_planned_asset_allocation = get_value(i,"a_planned_asset_allocation", template_fields)
-    f_percentage_aligned_with_e_s_characteristics = get_value(i,"f_percentage_aligned_with_e_s_characteristics", template_fields)
-    a_minimum_extent_taxonomy_alignment = get_value(i,"a_minimum_extent_taxonomy_alignment", template_fields)
-    f_taxonomy_aligned_fossil_gas_incl_sov_bonds = get_value(i,"f_taxonomy_aligned_fossil_gas_incl_sov_bonds", template_fields)
-    f_non_taxonomy_aligned_fossil_gas_incl_sov_bonds = get_value(i,"f_non_taxonomy_aligned_fossil_gas_incl_sov_bonds", template_fields)
-    f_taxonomy_aligned_fossil_gas_excl_sov_bonds = get_value(i,"f_taxonomy_aligned_fossil_gas_excl_sov_bonds", template_fields)
-    f_non_taxonomy_aligned_fossil_gas_excl_sov_bonds = get_value(i,"f_non_taxonomy_aligned_fossil_gas_excl_sov_bonds", template_fields)
-    a_minimum_share_social_investment = get_value(i,"a_minimum_share_social_investment", template_fields)
-    a_investment_included_in_other = get_value(i,"a_investment_included_in_other", template_fields)
-    a_promoted_e_s_characteristics = get_value(i,"a_promoted_e_s_characteristics", template_fields)
-    a_sustainability_indicators_used = get_value(i,"a_sustainability_indicators_used", template_fields)
-    a_sustainable_investment_objectives = get_value(i,"a_sustainable_investment_objectives", template_fields)
-    sm_environmental_objective_taxonomy = get_value(i,"sm_environmental_objective_taxonomy", template_fields)
-    sm_minimum_sustainable_investment_env_taxonomy = get_value(i,"sm_minimum_sustainable_investment_env_taxonomy", template_fields)
-    a_minimum_share_env_objective = get_value(i,"a_minimum_share_env_objective", template_fields)
-    a_no_significant_harm = get_value(i,"a_no_significant_harm", template_fields)
-    a_accounting_indicators_on_sustainability_factors = get_value(i,"a_accounting_indicators_on_sustainability_factors", template_fields)
-    a_principal_adverse_impacts_explaination = get_value(i,"a_principal_adverse_impacts_explaination", template_fields)
-    a_alignment_with_OECD_guidelines = get_value(i,"a_alignment_with_OECD_guidelines", template_fields)
+    fields = {name: get_value(i, name, template_fields) for name in required_fields(rules)}
 
-    #################### Check for basic validation conditions ####################
-    # basic validation conditions are such conditions that can be simply answered with yes or no
-    # e.g., answer for specific questions has been provided and contains a numerical value
+    results = {}
+    rule_seconds = {}
+    rule_usage = {}
 
-    ##### 1. Check that the boxes in the table are ticked (and % if sustainable investments).
-    value = True
-    comment = ""
-    
-    # 1A
-    if (sm_sustainable_investment_object_yes != "selected") & (sm_sustainable_investment_object_no != "selected"):
-        value = False
-        comment += "No selection made for sustainable investment object. "
-    
-    # 1B / 1C
-    if sm_sustainable_investment_object_yes == "selected":
-        relevant_sms = [sm_environmental_objective, sm_social_objective]
-    elif sm_sustainable_investment_object_no == "selected":
-        relevant_sms = [sm_minimum_sustainable_investment, sm_no_sustainable_investment]
-    else:
-        relevant_sms = []
-   
-    num_selected = 0
-    for sm in relevant_sms:
-        if sm == "selected":
-            num_selected += 1
-    if num_selected == 0:
-        value = False
-        comment += "No selection made for promotion of sustainable investment objective. "
+    # each chain of rules runs in its own thread
+    def run_chain(chain):
+        for rule in chain:
+            usage = {"input_tokens": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached": None}
+            start = time.perf_counter()
+            results[rule["id"]] = run_check(rule["check"], fields, usage, results.get(rule.get("depends_on")))
+            rule_seconds[rule["id"]] = time.perf_counter() - start
+            rule_usage[rule["id"]] = usage
 
-    # apparently no problem if more than one of the selection marks is selected
-    """if num_selected > 1:
-        value = False
-        comment += "More than one selection made for promotion of sustainable investment objective. " """
+    with ThreadPoolExecutor(max_workers=LLM_CHECK_WORKERS) as executor:
+        list(executor.map(run_chain, rule_chains(rules)))
 
-    # 1D
-    if sm_environmental_objective == "selected":
-        if len([int(s) for s in f_environmental_objective if s.isdigit()]) == 0:
-            value = False
-            comment += "Environmental objective selected but no minimum % provided. "
-    elif sm_social_objective == "selected":
-        if len([int(s) for s in f_social_objective if s.isdigit()]) == 0:
-            value = False
-            comment += "Social objective selected but no minimum % provided. "
-    elif sm_minimum_sustainable_investment == "selected":
-        if len([int(s) for s in f_minimum_sustainable_investment if s.isdigit()]) == 0:
-            value = False
-            comment += "Minimum sustainable investment selected but no minimum % provided. "
+    return collect_conditions(i, rules, results, rule_seconds, rule_usage, metrics)
 
-    # Save validation result
-    condition = {
-        "name": "Table filled correctly?",
-        "description": 'Check that the boxes in the table are ticked (and % if sustainable investments). / Tarkista että taulukon ruutuihin täytetty ruksit (ja %-osuus, jos kestäviä sijoituksia). [Table page 1]', 
-        "value": value,
-        "comment": comment
-    }
-    conditions.append(condition)
+async def validate_advanced_conditions_async(template_fields, i, metrics: list = None) -> list:
+    # like validate_advanced_conditions, each chain of rules runs as a task on the event loop of the caller
+    rules = [rule for rule in active_rules() if rule["llm"]]
+    fields = {name: get_value(i, name, template_fields) for name in required_fields(rules)}
 
-    ##### 7. If the product promotes environmental features you should add this statement. Standard mutoinen!
-    if (sm_environmental_objective == "selected") or (sm_minimum_sustainable_investment == "selected"):
+    results = {}
+    rule_seconds = {}
+    rule_usage = {}
 
-        value = False
-        comment = "Product promotes environmental features and 'No significant harm' statement has not been included."
+    async def run_chain(chain):
+        for rule in chain:
+            usage = {"input_tokens": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached": None}
+            start = time.perf_counter()
+            results[rule["id"]] = await run_check_async(rule["check"], fields, usage, results.get(rule.get("depends_on")))
+            rule_seconds[rule["id"]] = time.perf_counter() - start
+            rule_usage[rule["id"]] = usage
 
-        relevant_text = a_no_significant_harm + a_alignment_with_OECD_guidelines
-        do_not_harm_statement_excerpt = 'EU:n luokitusjärjestelmässä vahvistetaan "ei merkittävää haittaa" -periaate'
+    await asyncio.gather(*[run_chain(chain) for chain in rule_chains(rules)])
 
-        if do_not_harm_statement_excerpt in relevant_text:
-            value = True
-            comment = ""
-            
-    else:
-        value = True
-        comment = "'No significant harm' statement not required, product does not promote environmental features."
+    return collect_conditions(i, rules, results, rule_seconds, rule_usage, metrics)
 
-    # Save validation result
-    condition = {
-        "name": "'No significant harm' statement provided?",
-        "description": 'If the product promotes environmental features you should add this statement. Standard mutoinen! / Jos tuote edistää ympäristöominaisuuksia tulee lisätä tämä statement. Vakio mutoinen! [Standard Statement below "How do the sustainable investments that the financial product partially intends to make, not cause significant harm to any environmental or social sustainable investment objective?"]', 
-        "value": value,
-        "comment": comment
-    }
-    conditions.append(condition)
+#################### Basic validation rules ####################
+# each rule gets the required fields of all templates (one row per template, missing values as empty string)
+# and returns value and comment for all templates
 
-    ##### 10. A description should be added
-    if (type(a_planned_asset_allocation) == str) & (len(a_planned_asset_allocation) > 5):
-        value = True
-        comment = ""
-    else:
-        value = False
-        comment = "No answer found."
+def contains_digit(column):
+    return column.str.contains(r"\d", regex=True)
 
-    # Save validation result
-    condition = {
-        "name": "Description for planned asset allocation added?",
-        "description": 'Answer to question "What is the asset allocation planned for this financial product?" should be provided. / Tulee lisätä kuvaus tähän. ["What is the asset allocation planned for this financial product?"]', 
-        "value": value,
-        "comment": comment
-    }
-    conditions.append(condition)
+def text_if(mask, text: str):
+    # text where mask is True, otherwise empty string
+    return mask.map({True: text, False: ""})
 
-    #### 12. Check that % min 70%  
-    value = False
-    comment = "Percentage of assets aligned with E/S characteristics not found."
+def selected(column):
+    return column == "selected"
 
-    if type(f_percentage_aligned_with_e_s_characteristics) == str:
-        digits = [int(s) for s in f_percentage_aligned_with_e_s_characteristics if s.isdigit()]
+def check_table_filled(fields):
+    ##### 1. Check that the boxes in the table are ticked (and % if sustainable investments).
+    sm_sustainable_investment_object_yes = selected(fields["sm_sustainable_investment_object_yes"])
+    sm_sustainable_investment_object_no = selected(fields["sm_sustainable_investment_object_no"])
+    sm_environmental_objective = selected(fields["sm_environmental_objective"])
+    sm_social_objective = selected(fields["sm_social_objective"])
+    sm_minimum_sustainable_investment = selected(fields["sm_minimum_sustainable_investment"])
+    sm_no_sustainable_investment = selected(fields["sm_no_sustainable_investment"])
 
-        if len(digits) > 0:
-            number = int("".join(str(s) for s in digits))
+    # 1A
+    no_object_selected = ~sm_sustainable_investment_object_yes & ~sm_sustainable_investment_object_no
 
-            if number >= 70:
-                value = True
-                comment = ""
-            else:
-                value = False
-                comment = "Percentage of assets aligned with E/S characteristics below 70 %."
+    # 1B / 1C
+    # apparently no problem if more than one of the selection marks is selected
+    promotion_selected = (sm_sustainable_investment_object_yes & (sm_environmental_objective | sm_social_objective)) | \
+                         (~sm_sustainable_investment_object_yes & sm_sustainable_investment_object_no & (sm_minimum_sustainable_investment | sm_no_sustainable_investment))
 
-    if value == False:
-        if len([int(s) for s in a_minimum_extent_taxonomy_alignment if s.isdigit()]) > 0:
-            value = True
-            comment = ""
-        
-    # Save validation result
-    condition = {
-        "name": "Percentage of aligned assets min 70%?",
-        "description": 'Percentage of assets aligned with E/S characteristics should be provided and at least 70 %. / Tarkista että % min 70% [Boxes below "To what minimum extent are sustainable investments with an environmental objective aligned with the EU Taxonomy?"]', 
-        "value": value,
-        "comment": comment
-    }
-    conditions.append(condition)
+    # 1D
+    environmental_missing = sm_environmental_objective & ~contains_digit(fields["f_environmental_objective"])
+    social_missing = ~sm_environmental_objective & sm_social_objective & ~contains_digit(fields["f_social_objective"])
+    minimum_missing = ~sm_environmental_objective & ~sm_social_objective & sm_minimum_sustainable_investment & ~contains_digit(fields["f_minimum_sustainable_investment"])
+
+    value = ~no_object_selected & promotion_selected & ~environmental_missing & ~social_missing & ~minimum_missing
+    comment = text_if(no_object_selected, "No selection made for sustainable investment object. ") + \
+              text_if(~promotion_selected, "No selection made for promotion of sustainable investment objective. ") + \
+              text_if(environmental_missing, "Environmental objective selected but no minimum % provided. ") + \
+              text_if(social_missing, "Social objective selected but no minimum % provided. ") + \
+              text_if(minimum_missing, "Minimum sustainable investment selected but no minimum % provided. ")
+    return value, comment
+
+def check_no_significant_harm_statement(fields):
+    ##### 7. If the product promotes environmental features you should add this statement. Standard mutoinen!
+    promotes_environmental_features = selected(fields["sm_environmental_objective"]) | selected(fields["sm_minimum_sustainable_investment"])
+    do_not_harm_statement_excerpt = 'EU:n luokitusjärjestelmässä vahvistetaan "ei merkittävää haittaa" -periaate'
+    statement_included = (fields["a_no_significant_harm"] + fields["a_alignment_with_OECD_guidelines"]).str.contains(do_not_harm_statement_excerpt, regex=False)
 
-    #### 13. If you promote environmental features, you should indicate to what extent sustainable investments are in line with the EU taxonomy. If not committed to taxonomy compliant investments should fill in 0%. In other words, you cannot delete this question even if you do not have taxonomy compliant investments if you promote environmental 
-    value = False
-    comment = "The % of investments in line with EU taxonomy has not been provided."
+    value = ~promotes_environmental_features | statement_included
+    comment = text_if(promotes_environmental_features & ~statement_included, "Product promotes environmental features and 'No significant harm' statement has not been included.") + \
+              text_if(~promotes_environmental_features, "'No significant harm' statement not required, product does not promote environmental features.")
+    return value, comment
 
-    for var in [a_minimum_extent_taxonomy_alignment, a_planned_asset_allocation]:
-        if type(var) == str:
-            # check if answer contains "%" and digits
-            if (len([int(s) for s in var if s.isdigit()]) > 0) & ("%" in var):
-                value = True
-                comment = ""
+def check_planned_asset_allocation(fields):
+    ##### 10. A description should be added
+    value = fields["a_planned_asset_allocation"].str.len() > 5
+    comment = text_if(~value, "No answer found.")
+    return value, comment
+
+def aligned_percentage(fields):
+    # all digits of the answer form the percentage (NaN if the answer contains no digits)
+    digits = fields["f_percentage_aligned_with_e_s_characteristics"].str.replace(r"\D", "", regex=True)
+    percentage_found = digits != ""
+    percentage = pd.to_numeric(digits.where(percentage_found), errors="coerce")
+    return percentage, percentage_found
+
+def check_aligned_percentage(fields):
+    #### 12. Check that % min 70%  
+    percentage, percentage_found = aligned_percentage(fields)
 
-    # Save validation result
-    condition = {
-        "name": "EU Taxonomy alignment indicated?",
-        "description": 'If you promote environmental features, you should indicate to what extent sustainable investments are in line with the EU taxonomy. If not committed to taxonomy compliant investments should fill in 0%. Either way, the answer should contain a percentage value. / Jos edistää ympäristöominaisuuksia tulee kertoa missä määrin kestävät sijoitukset ovat EU taksonomian mukaisia. Jos ei ole sitoutunut taksonianmukaisiin sijoituksiin tulee täyttää 0%. Eli ei saa poistaa kyseistä kysymystä vaikka ei olisi taksonomian mukaisia sijoituksia jos edistää ympäristöominaisuuksia. ["To what minimum extent are sustainable investments with an environmental objective aligned with the EU Taxonomy?"]', 
-        "value": value,
-        "comment": comment
-    }
-    conditions.append(condition)
+    value = (percentage >= 70) | contains_digit(fields["a_minimum_extent_taxonomy_alignment"])
+    comment = text_if(~value & percentage_found, "Percentage of assets aligned with E/S characteristics below 70 %.") + \
+              text_if(~value & ~percentage_found, "Percentage of assets aligned with E/S characteristics not found.")
+    return value, comment
 
-    #### 16. If the product invests in sustainable investments with a social objective, it should be disclosed what their share is. 
-    if sm_social_objective == "selected":
-        value = False
-        comment = "Minimum share of social objective investments not provided"
+def check_taxonomy_alignment(fields):
+    #### 13. If you promote environmental features, you should indicate to what extent sustainable investments are in line with the EU taxonomy. If not committed to taxonomy compliant investments should fill in 0%. In other words, you cannot delete this question even if you do not have taxonomy compliant investments if you promote environmental 
+    # check if answer contains "%" and digits
+    a_minimum_extent_taxonomy_alignment = fields["a_minimum_extent_taxonomy_alignment"]
+    a_planned_asset_allocation = fields["a_planned_asset_allocation"]
 
-        if type(a_minimum_share_social_investment) == str:
-            if (len([int(s) for s in a_minimum_share_social_investment if s.isdigit()]) > 0) & ("%" in a_minimum_share_social_investment):
-                value = True
-                comment = ""
-    else:
-        value = True
-        comment = "Information not required, no sustainable investments with a social objective."
+    value = (contains_digit(a_minimum_extent_taxonomy_alignment) & a_minimum_extent_taxonomy_alignment.str.contains("%", regex=False)) | \
+            (contains_digit(a_planned_asset_allocation) & a_planned_asset_allocation.str.contains("%", regex=False))
+    comment = text_if(~value, "The % of investments in line with EU taxonomy has not been provided.")
+    return value, comment
 
-    # Save validation result
-    condition = {
-        "name": "Minimum share of sustainable investments with social objective disclosed?",
-        "description": 'If the product invests in sustainable investments with a social objective, it should be disclosed what their share is. / Jos tuote sijoittaa kestäviin sijoituksiin joilla on yhteiskunnallinen tavoitteite tulee kertoa mikä niiden osuus on. ["What is the minimum share of socially sustainable investments?"]', 
-        "value": value,
-        "comment": comment
-    }
-    conditions.append(condition)
+def check_social_investment_share(fields):
+    #### 16. If the product invests in sustainable investments with a social objective, it should be disclosed what their share is. 
+    sm_social_objective = selected(fields["sm_social_objective"])
+    a_minimum_share_social_investment = fields["a_minimum_share_social_investment"]
+    share_disclosed = contains_digit(a_minimum_share_social_investment) & a_minimum_share_social_investment.str.contains("%", regex=False)
+
+    value = ~sm_social_objective | share_disclosed
+    comment = text_if(sm_social_objective & ~share_disclosed, "Minimum share of social objective investments not provided") + \
+              text_if(~sm_social_objective, "Information not required, no sustainable investments with a social objective.")
+    return value, comment
 
+def check_other_investments(fields):
     #### 17. If the product invests in other investments "other" should be given in the question details.
-    value = False
-    comment = "Other investments not specified."
-    
-    if (type(a_investment_included_in_other) == str):
-        if (len(a_investment_included_in_other) > 5):
-            value = True
-            comment = ""
-        
-    if type(f_percentage_aligned_with_e_s_characteristics) == str:
-        digits = [int(s) for s in f_percentage_aligned_with_e_s_characteristics if s.isdigit()]
-        if len(digits) > 0:
-            number = int("".join(str(s) for s in digits))
-            if number == 100:
-                value = True
-                comment = "No other investments"
+    percentage, percentage_found = aligned_percentage(fields)
+    other_specified = fields["a_investment_included_in_other"].str.len() > 5
+    no_other_investments = percentage == 100
 
-    # Save validation result
-    condition = {
-        "name": "Other investments specified?",
-        "description": 'If the product invests in other investments "other" should be given in the question details. / Jos tuote sijoittaa muihin sijoituksiin ”other” tulee antaa kysymyksen tiedot. ["What investments are included under “#2 Other”, what is their purpose and are there any minimum environmental or social safeguards?"]', 
-        "value": value,
-        "comment": comment
-    }
-    conditions.append(condition)
+    value = other_specified | no_other_investments
+    comment = text_if(no_other_investments, "No other investments") + \
+              text_if(~other_specified & ~no_other_investments, "Other investments not specified.")
+    return value, comment
 
+#################### Advanced validation rules ####################
+# each rule gets the required fields of one template, a dict for the token usage of its LLM requests and
+# the result of the rule it depends on (if any), and returns a dict with value and comment.
+# Rules are generators: each LLM request is yielded as (check id, system prompt, text) and the answer is sent back
+# (see run_check / run_check_async), so the same rule runs in a thread or on an event loop.
 
-    #################### Check for advanced validation conditions ####################
-    # advanced validation conditions are such conditions that require reasoning capabilities
-    # e.g., "The description should indicate whether the fund promotes E and S or both."
-    # the reasoning of a large language model (ChatGPT) is used for this task
+def check_promoted_characteristics(fields, usage, previous=None):
+    a_promoted_e_s_characteristics = fields["a_promoted_e_s_characteristics"]
 
     #### 3. The description should indicate whether the fund promotes E and S or both.
     system = """You are provided with a description of environmental and/or social characteristics that are promoted by finanicial product.
@@ -260,15 +466,9 @@ def validate(template_fields, i):
     """
     text = a_promoted_e_s_characteristics
 
-    response = openai.ChatCompletion.create(
-        engine="gpt-4", 
-        messages=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": text}
-        ]
-    )
-    resp = response['choices'][0]['message']['content']
+    resp = yield ("3", system, text)
 
+    prev_resp = None
     if resp == "both":
         value = True
         comment = "Products promotes environmental and social characteristics."
@@ -284,17 +484,13 @@ def validate(template_fields, i):
     else:
         value = False
         comment = "No clear explaination provided of what environmental and/or social characteristics are promoted by the product."
-    
-    prev_value = value
 
-    # Save validation result
-    condition = {
-        "name": "Promoted E/S characteristics indicated?",
-        "description": 'The description should indicate whether the fund promotes E and S or both. / Kuvauksesta tulee käydä ilmi edistääkö rahasto E ja S vai jompaakumpaa. ["What environmental and/or social characteristics are promoted by this financial product? "]', 
-        "value": value,
-        "comment": comment
-    }
-    conditions.append(condition)
+    return {"value": value, "comment": comment, "promoted_characteristics": prev_resp}
+
+def check_sustainability_indicators(fields, usage, previous=None):
+    a_sustainability_indicators_used = fields["a_sustainability_indicators_used"]
+    prev_value = previous["value"]
+    prev_resp = previous["promoted_characteristics"]
 
     #### 4. The indicators should be consistent with the previous question.
     if prev_value == False:
@@ -308,14 +504,7 @@ def validate(template_fields, i):
         """
         text = a_sustainability_indicators_used
 
-        response = openai.ChatCompletion.create(
-            engine="gpt-4", 
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": text}
-            ]
-        )
-        resp = response['choices'][0]['message']['content']
+        resp = yield ("4", system, text)
 
         try:
             resp_dict = json.loads(resp)
@@ -328,14 +517,11 @@ def validate(template_fields, i):
             value = False
             comment = "Not able to judge the adequancy of the described sustainability indicators. Exception: " + str(e)
 
-    # Save validation result
-    condition = {
-        "name": "Consistent sustainability indicators?",
-        "description": 'The indicators should be consistent with the previous question. / Indikaattorit tulevat olla yhteneväisiä edellisen kysymyksen kanssa. ["What sustainability indicators are used to measure the attainment of each of the environmental or social characteristics promoted by this financial product?"]', 
-        "value": value,
-        "comment": comment
-    }
-    conditions.append(condition)
+    return {"value": value, "comment": comment}
+
+def check_sfdr_objectives(fields, usage, previous=None):
+    sm_minimum_sustainable_investment = fields["sm_minimum_sustainable_investment"]
+    a_sustainable_investment_objectives = fields["a_sustainable_investment_objectives"]
 
     #### 5. If the table on the first page indicates that the fund makes sustainable investments, the objective of the sustainable investment should be described, which should be in line with the objectives of SFDR Article 2.17. In addition, if the table indicates that the fund includes taxonomy investments, the taxonomy objective to be promoted should be stated.
 
@@ -362,14 +548,7 @@ def validate(template_fields, i):
 
             text = a_sustainable_investment_objectives
 
-            response = openai.ChatCompletion.create(
-                engine="gpt-4", 
-                messages=[
-                    {"role": "system", "content": system},
-                    {"role": "user", "content": text}
-                ]    
-            )
-            resp = response['choices'][0]['message']['content']
+            resp = yield ("5", system, text)
 
             try:
                 resp_dict = json.loads(resp)
@@ -390,14 +569,12 @@ def validate(template_fields, i):
         value = True
         comment = "Answer not required. No sustainable investment objective."
 
-    # Save validation result
-    condition = {
-        "name": "Objectives align with SFDR Article 2.17?",
-        "description": 'If the table on the first page indicates that the fund makes sustainable investments, the objective of the sustainable investment should be described, which should be in line with the objectives of SFDR Article 2.17. / Jos ensimmäisen sivun taulukon mukaan rahasto tekee kestäviä sijoituksia, tulee kuvata kestävän sijoituksen tavoite, jonka tulee vastata SFDR artikla 2.17 tavoitteita. ["What are the objectives of the sustainable investments that the financial product partially intends to make and how does the sustainable investment contribute to such objectives? "]', 
-        "value": value,
-        "comment": comment
-    }
-    conditions.append(condition)
+    return {"value": value, "comment": comment}
+
+def check_taxonomy_objective(fields, usage, previous=None):
+    sm_minimum_sustainable_investment = fields["sm_minimum_sustainable_investment"]
+    sm_minimum_sustainable_investment_env_taxonomy = fields["sm_minimum_sustainable_investment_env_taxonomy"]
+    a_sustainable_investment_objectives = fields["a_sustainable_investment_objectives"]
 
     #### 5b. If the table on the first page indicates that the fund makes sustainable investments and the fund includes taxonomy investments, the taxonomy objective to be promoted should be stated.
 
@@ -414,14 +591,7 @@ def validate(template_fields, i):
 
                 text = a_sustainable_investment_objectives
 
-                response = openai.ChatCompletion.create(
-                    engine="gpt-4", 
-                    messages=[
-                        {"role": "system", "content": system},
-                        {"role": "user", "content": text}
-                    ]    
-                )
-                resp = response['choices'][0]['message']['content']
+                resp = yield ("5b", system, text)
 
                 try:
                     resp_dict = json.loads(resp)
@@ -446,14 +616,13 @@ def validate(template_fields, i):
         value = True
         comment = "Answer not required. No sustainable investment objective."
 
-    # Save validation result
-    condition = {
-        "name": "Promoted taxonomy objective stated?",
-        "description": 'If the table on the first page indicates that the fund makes sustainable investments and the fund includes taxonomy investments, the taxonomy objective to be promoted should be stated. / Lisäksi jos rahasto sisältää taulukon mukaan taksonomian mukaisia sijoituksia tulee kertoa mitä taksonmian mukaista tavoitetta edistää. ["What are the objectives of the sustainable investments that the financial product partially intends to make and how does the sustainable investment contribute to such objectives? "]', 
-        "value": value,
-        "comment": comment
-    }
-    conditions.append(condition)
+    return {"value": value, "comment": comment}
+
+def check_annex_1_indicators(fields, usage, previous=None):
+    sm_minimum_sustainable_investment = fields["sm_minimum_sustainable_investment"]
+    a_no_significant_harm = fields["a_no_significant_harm"]
+    a_accounting_indicators_on_sustainability_factors = fields["a_accounting_indicators_on_sustainability_factors"]
+    a_principal_adverse_impacts_explaination = fields["a_principal_adverse_impacts_explaination"]
 
     #### 6. If the fund makes sustainable investments (i.e. ticked and % indicated in the table on the first page), the annex I indicators that are monitored in order not to cause significant harm must be listed (it is not enough to mention but to report the annex I indicators).
     if sm_minimum_sustainable_investment == "selected":
@@ -470,14 +639,7 @@ def validate(template_fields, i):
         If indicators_listed is False, you should mention all indicators that have not been listed in the provided text in the comment. Otherwise the comment can be an empty string like "".
         Your answer must not contain anything else."""
         
-        response = openai.ChatCompletion.create(
-            engine="gpt-4", 
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": relevant_text}
-            ]    
-        )
-        resp = response['choices'][0]['message']['content']
+        resp = yield ("6", system, relevant_text)
 
         try:
             resp_dict = json.loads(resp)
@@ -494,15 +656,11 @@ def validate(template_fields, i):
         value = True
         comment = "Answer not required. No sustainable investments."
 
-    # Save validation result
-    condition = {
-        "name": "Annex I indicators listed?",
-        "description": 'If the fund makes sustainable investments (i.e. ticked and % indicated in the table on the first page), the annex I indicators that are monitored in order not to cause significant harm must be listed (it is not enough to mention but to report the annex I indicators). / Jos rahasto tekee kestäviä sijoituksia (eli ensimmäisen sivun taulukossa valittu ruksi ja ilmoitettu %), tulee luetella ne annex I indikaattorit joita seurataan jotta ei aiheuta merkittävää haittaa ( ei siis riitä että mainitaan vaan että raportoidaan annex I mukaiset indikaattorit). ["How do the sustainable investments that the financial product partially intends to make, not cause significant harm to any environmental or social sustainable investment objective? "]', 
-        "value": value,
-        "comment": comment
-    }
-    conditions.append(condition)
-    
+    return {"value": value, "comment": comment}
+
+def check_taxonomy_non_compliance(fields, usage, previous=None):
+    sm_minimum_sustainable_investment = fields["sm_minimum_sustainable_investment"]
+    a_minimum_share_env_objective = fields["a_minimum_share_env_objective"]
 
     #### 15. If the fund makes sustainable investments with an environmental objective, it should explain why it invests in sustainable investments that have an environmental objective but do not comply with the taxonomy
     #  if 5.) is selected, let ChatGPT check if 25.) provides reasonable explaination why it invests in sustainable investments that have an environmental objective but do not comply with the taxonomy -> yes/no/unclear
@@ -517,14 +675,7 @@ def validate(template_fields, i):
 
         text = a_minimum_share_env_objective
 
-        response = openai.ChatCompletion.create(
-            engine="gpt-4", 
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": text}
-            ]    
-        )
-        resp = response['choices'][0]['message']['content']
+        resp = yield ("15", system, text)
 
         try:
             resp_dict = json.loads(resp)
@@ -541,13 +692,116 @@ def validate(template_fields, i):
         value = True
         comment = "Answer not required. No sustainable investments with an environmental objective."
 
-    # Save validation result
-    condition = {
+    return {"value": value, "comment": comment}
+
+#################### Registry of validation rules ####################
+# id (number of the check in the validation guideline), name and description (shown in the results), required input fields,
+# whether the LLM is needed, function that checks the rule and (optional) id of the rule whose result is needed.
+# Results are reported in the order of this list: basic validation conditions first, then advanced validation conditions.
+RULES = [
+    {
+        "id": "1",
+        "name": "Table filled correctly?",
+        "description": 'Check that the boxes in the table are ticked (and % if sustainable investments). / Tarkista että taulukon ruutuihin täytetty ruksit (ja %-osuus, jos kestäviä sijoituksia). [Table page 1]',
+        "fields": ["sm_sustainable_investment_object_yes", "sm_sustainable_investment_object_no", "sm_environmental_objective", "sm_social_objective", "sm_minimum_sustainable_investment", "sm_no_sustainable_investment", "f_environmental_objective", "f_social_objective", "f_minimum_sustainable_investment"],
+        "llm": False,
+        "check": check_table_filled
+    },
+    {
+        "id": "7",
+        "name": "'No significant harm' statement provided?",
+        "description": 'If the product promotes environmental features you should add this statement. Standard mutoinen! / Jos tuote edistää ympäristöominaisuuksia tulee lisätä tämä statement. Vakio mutoinen! [Standard Statement below "How do the sustainable investments that the financial product partially intends to make, not cause significant harm to any environmental or social sustainable investment objective?"]',
+        "fields": ["sm_environmental_objective", "sm_minimum_sustainable_investment", "a_no_significant_harm", "a_alignment_with_OECD_guidelines"],
+        "llm": False,
+        "check": check_no_significant_harm_statement
+    },
+    {
+        "id": "10",
+        "name": "Description for planned asset allocation added?",
+        "description": 'Answer to question "What is the asset allocation planned for this financial product?" should be provided. / Tulee lisätä kuvaus tähän. ["What is the asset allocation planned for this financial product?"]',
+        "fields": ["a_planned_asset_allocation"],
+        "llm": False,
+        "check": check_planned_asset_allocation
+    },
+    {
+        "id": "12",
+        "name": "Percentage of aligned assets min 70%?",
+        "description": 'Percentage of assets aligned with E/S characteristics should be provided and at least 70 %. / Tarkista että % min 70% [Boxes below "To what minimum extent are sustainable investments with an environmental objective aligned with the EU Taxonomy?"]',
+        "fields": ["f_percentage_aligned_with_e_s_characteristics", "a_minimum_extent_taxonomy_alignment"],
+        "llm": False,
+        "check": check_aligned_percentage
+    },
+    {
+        "id": "13",
+        "name": "EU Taxonomy alignment indicated?",
+        "description": 'If you promote environmental features, you should indicate to what extent sustainable investments are in line with the EU taxonomy. If not committed to taxonomy compliant investments should fill in 0%. Either way, the answer should contain a percentage value. / Jos edistää ympäristöominaisuuksia tulee kertoa missä määrin kestävät sijoitukset ovat EU taksonomian mukaisia. Jos ei ole sitoutunut taksonianmukaisiin sijoituksiin tulee täyttää 0%. Eli ei saa poistaa kyseistä kysymystä vaikka ei olisi taksonomian mukaisia sijoituksia jos edistää ympäristöominaisuuksia. ["To what minimum extent are sustainable investments with an environmental objective aligned with the EU Taxonomy?"]',
+        "fields": ["a_minimum_extent_taxonomy_alignment", "a_planned_asset_allocation"],
+        "llm": False,
+        "check": check_taxonomy_alignment
+    },
+    {
+        "id": "16",
+        "name": "Minimum share of sustainable investments with social objective disclosed?",
+        "description": 'If the product invests in sustainable investments with a social objective, it should be disclosed what their share is. / Jos tuote sijoittaa kestäviin sijoituksiin joilla on yhteiskunnallinen tavoitteite tulee kertoa mikä niiden osuus on. ["What is the minimum share of socially sustainable investments?"]',
+        "fields": ["sm_social_objective", "a_minimum_share_social_investment"],
+        "llm": False,
+        "check": check_social_investment_share
+    },
+    {
+        "id": "17",
+        "name": "Other investments specified?",
+        "description": 'If the product invests in other investments "other" should be given in the question details. / Jos tuote sijoittaa muihin sijoituksiin ”other” tulee antaa kysymyksen tiedot. ["What investments are included under “#2 Other”, what is their purpose and are there any minimum environmental or social safeguards?"]',
+        "fields": ["f_percentage_aligned_with_e_s_characteristics", "a_investment_included_in_other"],
+        "llm": False,
+        "check": check_other_investments
+    },
+    {
+        "id": "3",
+        "name": "Promoted E/S characteristics indicated?",
+        "description": 'The description should indicate whether the fund promotes E and S or both. / Kuvauksesta tulee käydä ilmi edistääkö rahasto E ja S vai jompaakumpaa. ["What environmental and/or social characteristics are promoted by this financial product? "]',
+        "fields": ["a_promoted_e_s_characteristics"],
+        "llm": True,
+        "check": check_promoted_characteristics
+    },
+    {
+        "id": "4",
+        "name": "Consistent sustainability indicators?",
+        "description": 'The indicators should be consistent with the previous question. / Indikaattorit tulevat olla yhteneväisiä edellisen kysymyksen kanssa. ["What sustainability indicators are used to measure the attainment of each of the environmental or social characteristics promoted by this financial product?"]',
+        "fields": ["a_sustainability_indicators_used"],
+        "llm": True,
+        "check": check_sustainability_indicators,
+        "depends_on": "3"
+    },
+    {
+        "id": "5",
+        "name": "Objectives align with SFDR Article 2.17?",
+        "description": 'If the table on the first page indicates that the fund makes sustainable investments, the objective of the sustainable investment should be described, which should be in line with the objectives of SFDR Article 2.17. / Jos ensimmäisen sivun taulukon mukaan rahasto tekee kestäviä sijoituksia, tulee kuvata kestävän sijoituksen tavoite, jonka tulee vastata SFDR artikla 2.17 tavoitteita. ["What are the objectives of the sustainable investments that the financial product partially intends to make and how does the sustainable investment contribute to such objectives? "]',
+        "fields": ["sm_minimum_sustainable_investment", "a_sustainable_investment_objectives"],
+        "llm": True,
+        "check": check_sfdr_objectives
+    },
+    {
+        "id": "5b",
+        "name": "Promoted taxonomy objective stated?",
+        "description": 'If the table on the first page indicates that the fund makes sustainable investments and the fund includes taxonomy investments, the taxonomy objective to be promoted should be stated. / Lisäksi jos rahasto sisältää taulukon mukaan taksonomian mukaisia sijoituksia tulee kertoa mitä taksonmian mukaista tavoitetta edistää. ["What are the objectives of the sustainable investments that the financial product partially intends to make and how does the sustainable investment contribute to such objectives? "]',
+        "fields": ["sm_minimum_sustainable_investment", "sm_minimum_sustainable_investment_env_taxonomy", "a_sustainable_investment_objectives"],
+        "llm": True,
+        "check": check_taxonomy_objective
+    },
+    {
+        "id": "6",
+        "name": "Annex I indicators listed?",
+        "description": 'If the fund makes sustainable investments (i.e. ticked and % indicated in the table on the first page), the annex I indicators that are monitored in order not to cause significant harm must be listed (it is not enough to mention but to report the annex I indicators). / Jos rahasto tekee kestäviä sijoituksia (eli ensimmäisen sivun taulukossa valittu ruksi ja ilmoitettu %), tulee luetella ne annex I indikaattorit joita seurataan jotta ei aiheuta merkittävää haittaa ( ei siis riitä että mainitaan vaan että raportoidaan annex I mukaiset indikaattorit). ["How do the sustainable investments that the financial product partially intends to make, not cause significant harm to any environmental or social sustainable investment objective? "]',
+        "fields": ["sm_minimum_sustainable_investment", "a_no_significant_harm", "a_accounting_indicators_on_sustainability_factors", "a_principal_adverse_impacts_explaination"],
+        "llm": True,
+        "check": check_annex_1_indicators
+    },
+    {
+        "id": "15",
         "name": "Non-compliance with taxonomy explained?",
-        "description": 'If the fund makes sustainable investments with an environmental objective, it should explain why it invests in sustainable investments that have an environmental objective but do not comply with the taxonomy. /Jos rahasto tekee kestäviä sijoituksia joilla ympäristötavoite tulee kertoa miksi sijoittaa kestäviin sijoituksiin joilla on ympäristötavoite mutta eivät ole taksonomian mukaisia. ["What is the minimum share of sustainable investments with an environmental objective that are not aligned with the EU Taxonomy?"]', 
-        "value": value,
-        "comment": comment
+        "description": 'If the fund makes sustainable investments with an environmental objective, it should explain why it invests in sustainable investments that have an environmental objective but do not comply with the taxonomy. /Jos rahasto tekee kestäviä sijoituksia joilla ympäristötavoite tulee kertoa miksi sijoittaa kestäviin sijoituksiin joilla on ympäristötavoite mutta eivät ole taksonomian mukaisia. ["What is the minimum share of sustainable investments with an environmental objective that are not aligned with the EU Taxonomy?"]',
+        "fields": ["sm_minimum_sustainable_investment", "a_minimum_share_env_objective"],
+        "llm": True,
+        "check": check_taxonomy_non_compliance
     }
-    conditions.append(condition)
-
-    return conditions
+]